@@ -1,22 +1,149 @@
+import time
+IMPORT_START = time.perf_counter()
+
 import tkinter as tk
-from tkinter import messagebox, filedialog, simpledialog
+from tkinter import messagebox, filedialog, simpledialog, ttk
 from tkinter.colorchooser import askcolor
-from PIL import Image, ImageDraw, ImageTk, ImageColor, ImageFont
+from PIL import Image, ImageColor, ImageDraw, ImageTk
+import math
 import os
 import random
-from collections import deque
-import shutil
-import math
-import vlc
+import queue
+import threading
+from engine import Brush, Document, clip_bbox, intersect_bbox, text_layout, union_bbox
+from filters import FilterRunner, halo
+from fonts import FontRegistry
+from icons import IconAtlas
+from journal import Journal, replay
+from loader import FORMATS, Loader
+from project import EXTENSION, Project
+from saver import Saver
+from stamps import StampCache
+from stats import Stats
+
+
+class StartupProfile:
+    # Records how long each phase of startup takes
+    def __init__(self, start=None):
+        self.start = self.last = start if start is not None else time.perf_counter()
+        self.phases = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        lines = [f"{name}: {seconds * 1000:.1f} ms" for name, seconds in self.phases]
+        lines.append(f"total: {(self.last - self.start) * 1000:.1f} ms")
+        return "\n".join(lines)
+
+
+class SoundEngine:
+    # Sound effects from audio/, played on a worker thread from a small pool
+    # of reusable VLC players. VLC is only imported and started on the first
+    # play() call; if it is unavailable, or enabled is False, every call is a
+    # silent no-op.
+    def __init__(self, audio_dir="audio", channels=4, enabled=True):
+        self.audio_dir = audio_dir
+        self.channels = channels
+        self.enabled = enabled
+        self.commands = queue.Queue()
+        self.thread = None
+        self.media = {}
+        self.loop_media = {}
+        self.players = []
+        self.loop_player = None
+        self.next_player = 0
+
+    def play(self, name, loop=False):
+        if self.enabled:
+            self.send("play", name, loop)
+
+    def stop_loop(self):
+        if self.enabled and self.thread is not None:
+            self.send("stop")
+
+    def close(self):
+        if self.thread is not None:
+            self.commands.put(None)
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    def send(self, *command):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.commands.put(command)
+
+    def run(self):
+        started = self.start_backend()
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+            if not started:
+                continue
+            try:
+                if command[0] == "play":
+                    self.play_now(*command[1:])
+                elif command[0] == "stop":
+                    self.loop_player.stop()
+            except Exception:
+                pass
+        for player in self.players + [self.loop_player]:
+            if player is not None:
+                player.stop()
+                player.release()
+
+    def start_backend(self):
+        try:
+            import vlc
+            instance = vlc.Instance("--quiet", "--no-video")
+        except Exception:
+            return False
+        if instance is None:
+            return False
+        # Open and parse each effect once; loops get their own Media so the
+        # repeat option doesn't leak into one-shot playback
+        for file in os.listdir(self.audio_dir):
+            name, ext = os.path.splitext(file)
+            if ext.lower() != ".wav":
+                continue
+            path = os.path.join(self.audio_dir, file)
+            self.media[name] = instance.media_new(path)
+            self.media[name].parse()
+            self.loop_media[name] = instance.media_new(path, "input-repeat=65535")
+        self.players = [instance.media_player_new() for _ in range(self.channels)]
+        self.loop_player = instance.media_player_new()
+        return True
+
+    def play_now(self, name, loop):
+        if loop:
+            media = self.loop_media.get(name)
+            player = self.loop_player
+        else:
+            media = self.media.get(name)
+            player = self.players[self.next_player]
+            self.next_player = (self.next_player + 1) % len(self.players)
+        if media is None:
+            return
+        player.stop()
+        player.set_media(media)
+        player.play()
+
 
 class KP2:
-    def __init__(self, root):
+    def __init__(self, root, sound=True):
+        self.startup = StartupProfile(IMPORT_START)
+        self.startup.mark("imports")
         self.root = root
         self.root.title("Craftsman")
         image = Image.open("icon.png")
         photo = ImageTk.PhotoImage(image)
         root.iconphoto(True, photo)
         root.config(bg="#ece9d8") 
+        self.startup.mark("window icon")
 
         # Ensure required directories exist
         os.makedirs("cache", exist_ok=True)
@@ -26,8 +153,14 @@ class KP2:
         # Initial state
         self.saved = 1
         self.curpath = "NULL"
+        self.project = None  # the open .craft file, saved into incrementally
         self.current_tool = "pen"
         self.brush_size = 3
+        self.brush_size_var = tk.IntVar(value=self.brush_size)
+        # Pen and eraser dab a cached round tip along the stroke
+        self.brush_hardness = tk.IntVar(value=100)  # percent
+        self.brush_spacing = tk.IntVar(value=15)  # percent of the tip size
+        self.brush = None
         self.colors = [
             "#000000", "#FFFFFF", "#A1A192", "#E6EAD8", "#980000", "#FF3300",
             "#E68B2C", "#FFAA00", "#9B6600", "#FFFF00", "#008D00", "#00FF00",
@@ -40,56 +173,152 @@ class KP2:
             "#0e7dcb", "#800080", "#FF00FF"
         ]
         self.current_color = "#000000"
-
+        self.png_compression = tk.IntVar(value=6)
+        self.open_max_side = tk.IntVar(value=0)  # 0 opens at full size
+        self.fill_tolerance = tk.IntVar(value=0)
+        self.fill_connectivity = tk.IntVar(value=4)
+        self.spray_density = tk.IntVar(value=10)
+        self.spray_falloff = tk.DoubleVar(value=1.0)
+        self.spray_seed = None
+        self.spray_rng = None
+
+        # Text tool: faces come from an index in cache/, listed the first
+        # time the text panel is shown. Text is typed into the panel and
+        # previewed on the canvas until Enter places it.
+        self.fonts = FontRegistry("cache")
+        self.text_face = tk.StringVar(value="")
+        self.text_size = tk.IntVar(value=24)
+        self.text_value = tk.StringVar(value="")
+        self.text_faces_loaded = False
+        self.text_anchor = None
+        self.text_preview_item = None
+        self.text_preview_photo = None
+
+        # Stamps are only listed here; images are decoded on first use, and
+        # panel thumbnails come from an index in cache/
         self.stamps_dir = "stamps"
-        self.stamp_images = {}
+        self.stamp_files = {}
+        self.stamp_cache = StampCache("cache")
+        self.stamp_follow_brush = tk.BooleanVar(value=False)
+        self.stamps_built = False
         self.current_stamp = None
 
-        # Canvas size
+        # Canvas size; the document holds the tiled image and its undo
+        # history, which is bounded by memory rather than step count
         self.image_width, self.image_height = 800, 600
-        self.image = Image.new("RGBA", (self.image_width, self.image_height), "white")
-        self.draw = ImageDraw.Draw(self.image)
-
-        # Undo/redo stacks
-        self.undo_stack = deque(maxlen=20)
-        self.redo_stack = deque(maxlen=20)
+        self.undo_budget = 128 * 1024 * 1024
+        self.doc = Document(self.image_width, self.image_height, undo_budget=self.undo_budget)
+        # Fills on canvases bigger than this only spread over the visible area
+        self.max_fill_pixels = 4096 * 4096
+        # Zoom range as powers of two: 1/64 to 16x
+        self.min_zoom, self.max_zoom = -6, 4
 
         # Load resources
         self.load_stamps()
+        self.startup.mark("list stamps")
         self.gui_dir = "gui"
         self.load_gui_icons()
+        self.startup.mark("gui icons")
 
         # Build UI
         self.build_ui()
+        self.startup.mark("build ui")
 
         # Drawing state
         self.last_x = self.last_y = None
         self.start_x = self.start_y = None
-        self.temp_preview_image = None
+        self.preview_item = None
+
+        # Motion events are queued and drawn once per frame
+        self.frame_interval = 16  # ms, ~60 Hz
+        self.frame_job = None
+        self.pending_points = []
+
+        # Performance stats; off unless switched on from the View menu, and
+        # free while off. Opening and saving run on worker threads, which
+        # time themselves (see poll_loads and report_saves).
+        self.stats = Stats()
+        self.stats_visible = tk.BooleanVar(value=False)
+        self.stats_paths = ("on_paint", "flush_frame", "update_canvas_image", "paint_bucket", "spray",
+                            "draw_preview", "save_undo")
+        self.stats_job = None
+        self.stats_items = []
 
         # Bindings
-        self.canvas.bind("<Button-1>", self.on_button_press)
-        self.canvas.bind("<B1-Motion>", self.on_paint)
-        self.canvas.bind("<ButtonRelease-1>", self.on_button_release)
+        self.bind_tools()
         self.root.bind("<Control-z>", lambda e: self.undo())
         self.root.bind("<Control-y>", lambda e: self.redo())
+        self.root.bind("<Control-plus>", lambda e: self.set_zoom(self.zoom_level + 1))
+        self.root.bind("<Control-equal>", lambda e: self.set_zoom(self.zoom_level + 1))
+        self.root.bind("<Control-minus>", lambda e: self.set_zoom(self.zoom_level - 1))
+        self.root.bind("<Control-0>", lambda e: self.set_zoom(0))
+        self.root.bind("<Escape>", lambda e: self.cancel_filter())
 
         self.create_menu()
         self.update_bottom_panel()
-        self.save_undo()
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
-        # VLC player instance
-        self.instance = vlc.Instance()
-        self.player = self.instance.media_player_new()
-        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
-        self.loop = True
-        self.is_playing = False
-        self.updating_slider = False  # Flag to avoid conflict during slider update
+        # Sound effects; VLC isn't loaded until the first sound plays
+        self.sound = SoundEngine(enabled=sound)
+        self.startup.mark("menus and bindings")
+
+        # Saves are encoded and written on a worker thread, and opens are
+        # decoded on another
+        self.saver = Saver()
+        self.save_poll_job = None
+        self.loader = Loader()
+        self.loading = False
+        self.placeholder_item = None
+        self.placeholder_photo = None
+
+        # Filters run tile by tile on a process pool; input is held off
+        # until the result is in
+        self.filters = FilterRunner()
+        self.filtering = None
+
+        # Journal of every operation, for recovering from a crash
+        self.journal = Journal("cache")
+        self.stroke_log = []
+        # Imported stamps are journaled by path, so they live in the session
+        self.custom_stamps_dir = os.path.join(self.journal.directory, "custom_stamps")
+        self.recover_session()
+        self.startup.mark("journal")
+
+        self.root.after_idle(self.on_first_idle)
+
+    def on_first_idle(self):
+        self.startup.mark("first idle")
+        if os.environ.get("CRAFTSMAN_STARTUP_PROFILE"):
+            print(self.startup.report())
+        # Warm up NumPy (used by fill and spray) once the window is up
+        threading.Thread(target=__import__, args=("numpy",), daemon=True).start()
+
+    def recover_session(self):
+        if self.journal.has_recovery():
+            if messagebox.askyesno("Recover", "Craftsman did not close properly.\nRecover your unsaved work?"):
+                try:
+                    layers, records = self.journal.recover()
+                    self.doc.restore(layers)
+                    for record in records:
+                        replay(self.doc, record, self.stamp_cache.get, self.fonts.font)
+                    self.doc.history.clear()
+                    self.view_x = self.view_y = 0
+                    self.update_canvas_image()
+                    self.refresh_layers_panel()
+                    self.saved = 0
+                except Exception as e:
+                    messagebox.showerror("Recover", f"Could not recover the session:\n{e}")
+            else:
+                self.journal.discard_recovery()
+        self.journal.start(self.doc.snapshot(), self.doc.selection)
+
+    def show_startup_profile(self):
+        messagebox.showinfo("Startup Times", self.startup.report())
 
     def load_gui_icons(self):
-        self.icons = {}
-        icon_files = {
+        # Every icon comes out of one atlas image cached in cache/; each is
+        # copied out of a single PhotoImage of it by Tk
+        tool_icons = {
             "pen": "pen.png",
             "line": "line.png",
             "square": "square.png",
@@ -103,34 +332,21 @@ class KP2:
             "redo": "redo.png",
             "addcustom": "add.png",
         }
-        for tool, filename in icon_files.items():
-            path = os.path.join(self.gui_dir, filename)
-            try:
-                img = Image.open(path).resize((32, 32))
-                self.icons[tool] = ImageTk.PhotoImage(img)
-            except Exception:
-                self.icons[tool] = None
-
         brush_icons = {
             "small": "small.png",
             "medium": "medium.png",
             "large": "large.png"
         }
-        self.brush_icons = {}
-        for size, filename in brush_icons.items():
-            path = os.path.join(self.gui_dir, filename)
-            try:
-                img = Image.open(path).resize((32, 32))
-                self.brush_icons[size] = ImageTk.PhotoImage(img)
-            except Exception:
-                self.brush_icons[size] = None
-
-        color_icon_path = os.path.join(self.gui_dir, "color.png")
-        try:
-            img = Image.open(color_icon_path).resize((32, 32))
-            self.color_icon = ImageTk.PhotoImage(img)
-        except Exception:
-            self.color_icon = None
+        atlas, boxes = IconAtlas("cache", self.gui_dir).load({**tool_icons, **brush_icons, "color": "color.png"})
+        self.icon_atlas = ImageTk.PhotoImage(atlas) if atlas else None
+        icons = {}
+        for name, (x0, y0, x1, y1) in boxes.items():
+            icon = tk.PhotoImage(width=x1 - x0, height=y1 - y0)
+            icon.tk.call(str(icon), "copy", str(self.icon_atlas), "-from", x0, y0, x1, y1)
+            icons[name] = icon
+        self.icons = {name: icons.get(name) for name in tool_icons}
+        self.brush_icons = {name: icons.get(name) for name in brush_icons}
+        self.color_icon = icons.get("color")
 
     def build_ui(self):
         self.main_frame = tk.Frame(self.root, bg="#ece9d8")
@@ -141,13 +357,48 @@ class KP2:
         self.sidebar.pack(side=tk.LEFT)
         self.setup_sidebar()
 
-        # Main drawing canvas
-        self.canvas = tk.Canvas(self.main_frame, bg="white",
+        # Layers panel on the right
+        self.layers_frame = tk.Frame(self.main_frame, bg="#ece9d8")
+        self.layers_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=5)
+        self.setup_layers_panel()
+
+        # Main drawing canvas: a scrollable, zoomable viewport onto the
+        # document, which may be far bigger than the window. Only the visible
+        # part is ever converted for display. view_x/view_y are the document
+        # pixel at the top left; zoom_level n shows it at 2**n scale, and
+        # zoomed-out levels are read from the document's image pyramid.
+        self.view_frame = tk.Frame(self.main_frame, bg="#ece9d8")
+        self.view_frame.pack(side=tk.LEFT, anchor="nw", fill=tk.BOTH, expand=True)
+        self.view_x = self.view_y = 0
+        self.zoom_level = 0
+        self.pan_start = None
+        self.view_width, self.view_height = self.image_width, self.image_height
+        self.canvas = tk.Canvas(self.view_frame, bg="#808080", highlightthickness=0,
                                 width=self.image_width, height=self.image_height)
-        self.canvas.pack(side=tk.LEFT, anchor="nw", fill=None, expand=False)
-        self.canvas.pack(side=tk.TOP)
-        self.img_for_tk = ImageTk.PhotoImage(self.image)
-        self.image_on_canvas = self.canvas.create_image(0, 0, anchor="nw", image=self.img_for_tk)
+        self.hscroll = tk.Scrollbar(self.view_frame, orient=tk.HORIZONTAL, command=self.scroll_x)
+        self.vscroll = tk.Scrollbar(self.view_frame, orient=tk.VERTICAL, command=self.scroll_y)
+        self.canvas.grid(row=0, column=0, sticky="nsew")
+        self.vscroll.grid(row=0, column=1, sticky="ns")
+        self.hscroll.grid(row=1, column=0, sticky="ew")
+        self.view_frame.rowconfigure(0, weight=1)
+        self.view_frame.columnconfigure(0, weight=1)
+        self.img_for_tk = None
+        self.image_on_canvas = self.canvas.create_image(0, 0, anchor="nw")
+        self.canvas.bind("<Configure>", self.on_canvas_resize)
+        self.canvas.bind("<MouseWheel>", lambda e: self.scroll_y("scroll", -e.delta // 120, "units"))
+        self.canvas.bind("<Shift-MouseWheel>", lambda e: self.scroll_x("scroll", -e.delta // 120, "units"))
+        self.canvas.bind("<Button-4>", lambda e: self.scroll_y("scroll", -1, "units"))
+        self.canvas.bind("<Button-5>", lambda e: self.scroll_y("scroll", 1, "units"))
+        self.canvas.bind("<Control-MouseWheel>", lambda e: self.set_zoom(self.zoom_level + (1 if e.delta > 0 else -1), e.x, e.y))
+        self.canvas.bind("<Control-Button-4>", lambda e: self.set_zoom(self.zoom_level + 1, e.x, e.y))
+        self.canvas.bind("<Control-Button-5>", lambda e: self.set_zoom(self.zoom_level - 1, e.x, e.y))
+        self.canvas.bind("<ButtonPress-2>", self.on_pan_start)
+        self.canvas.bind("<B2-Motion>", self.on_pan)
+        self.redraw_view()
+
+        # Status bar, e.g. for saves running in the background
+        self.status = tk.Label(self.root, text="", anchor="w", bg="#ece9d8")
+        self.status.pack(side=tk.BOTTOM, fill=tk.X)
 
         # Bottom panel for colors, brush sizes, stamps
         self.bottom_panel = tk.Frame(self.root, height=50, bg="#ece9d8")
@@ -172,6 +423,8 @@ class KP2:
             ("text", self.use_text),
             ("stamp", self.use_stamps),
             ("eraser", self.use_eraser),
+            ("select", self.use_select),
+            ("wand", self.use_wand),
             ("undo", self.undo),
             ("redo", self.redo)
         ]
@@ -197,12 +450,195 @@ class KP2:
                 btn = tk.Button(brush_frame, text=name.capitalize(), command=lambda s=size: self.set_brush_size(s), bg="#ece9d8")
             btn.pack(pady=2, fill=tk.X)
 
+    def bind_tools(self):
+        # Rebound when stats are toggled, so the bindings pick up the
+        # (un)wrapped handlers
+        self.canvas.bind("<Button-1>", self.on_button_press)
+        self.canvas.bind("<B1-Motion>", self.on_paint)
+        self.canvas.bind("<ButtonRelease-1>", self.on_button_release)
+
+    def toggle_stats(self):
+        if self.stats_visible.get():
+            self.stats.reset()
+            self.stats.enable(self, self.stats_paths, label=lambda: self.current_tool,
+                              frames=("update_canvas_image",))
+            self.refresh_stats()
+        else:
+            self.stats.disable()
+            if self.stats_job is not None:
+                self.root.after_cancel(self.stats_job)
+                self.stats_job = None
+            for item in self.stats_items:
+                self.canvas.delete(item)
+            self.stats_items = []
+        self.bind_tools()
+
+    def history_bytes(self):
+        history = self.doc.history
+        return (sum(history.entry_bytes(entry) for entry in history.undo_stack),
+                sum(history.entry_bytes(entry) for entry in history.redo_stack))
+
+    def refresh_stats(self):
+        undo_bytes, redo_bytes = self.history_bytes()
+        history = self.doc.history
+        lines = [f"{self.stats.fps()} fps",
+                 f"undo {undo_bytes / 2 ** 20:.1f} MB ({len(history.undo_stack)})  "
+                 f"redo {redo_bytes / 2 ** 20:.1f} MB ({len(history.redo_stack)})"]
+        for row in self.stats.rows()[:8]:
+            lines.append(f"{row['name']}: {row['count']}x p50 {row['p50_ms']}ms "
+                         f"p95 {row['p95_ms']}ms max {row['max_ms']:.1f}ms")
+        for item in self.stats_items:
+            self.canvas.delete(item)
+        text = self.canvas.create_text(8, 8, anchor="nw", text="\n".join(lines), fill="white",
+                                       font=("Courier", 9))
+        box = self.canvas.create_rectangle(self.canvas.bbox(text), fill="black", outline="")
+        self.canvas.tag_lower(box, text)
+        self.stats_items = [box, text]
+        self.stats_job = self.root.after(500, self.refresh_stats)
+
+    def export_stats(self):
+        path = filedialog.asksaveasfilename(defaultextension=".json",
+                                            filetypes=[("JSON", "*.json"), ("CSV", "*.csv")])
+        if not path:
+            return
+        undo_bytes, redo_bytes = self.history_bytes()
+        try:
+            self.stats.export(path, {"undo_bytes": undo_bytes, "redo_bytes": redo_bytes,
+                                     "undo_steps": len(self.doc.history.undo_stack),
+                                     "redo_steps": len(self.doc.history.redo_stack)})
+        except OSError as e:
+            messagebox.showerror("Export Stats", f"Could not write {path}:\n{e}")
+
+    def setup_layers_panel(self):
+        tk.Label(self.layers_frame, text="Layers:", bg="#ece9d8").pack(pady=(5, 3))
+        self.layer_list = tk.Listbox(self.layers_frame, height=10, width=16, exportselection=False)
+        self.layer_list.pack(fill=tk.Y)
+        self.layer_list.bind("<<ListboxSelect>>", self.on_layer_select)
+        buttons = tk.Frame(self.layers_frame, bg="#ece9d8")
+        buttons.pack(fill=tk.X, pady=3)
+        for text, cmd in [("+", self.add_layer), ("-", self.delete_layer),
+                          ("Up", lambda: self.move_layer(1)), ("Down", lambda: self.move_layer(-1))]:
+            tk.Button(buttons, text=text, command=cmd, bg="#ece9d8").pack(side=tk.LEFT, expand=True, fill=tk.X)
+        self.layer_visible = tk.BooleanVar(value=True)
+        tk.Checkbutton(self.layers_frame, text="Visible", variable=self.layer_visible,
+                       command=self.set_layer_visible, bg="#ece9d8").pack(anchor="w")
+        self.layer_opacity = tk.IntVar(value=100)
+        tk.Scale(self.layers_frame, label="Opacity", from_=0, to=100, orient=tk.HORIZONTAL,
+                 variable=self.layer_opacity, command=self.set_layer_opacity, bg="#ece9d8").pack(fill=tk.X)
+        self.refresh_layers_panel()
+
+    def refresh_layers_panel(self):
+        # The list shows the top layer first
+        self.layer_list.delete(0, tk.END)
+        for layer in reversed(self.doc.layers):
+            self.layer_list.insert(tk.END, layer.name if layer.visible else f"({layer.name})")
+        row = len(self.doc.layers) - 1 - self.doc.active
+        self.layer_list.selection_set(row)
+        self.layer_list.see(row)
+        layer = self.doc.layers[self.doc.active]
+        self.layer_visible.set(layer.visible)
+        self.layer_opacity.set(round(layer.opacity * 100))
+
+    def layer_changed(self, bbox):
+        self.saved = 0
+        self.refresh_layers_panel()
+        if bbox:
+            self.update_canvas_image(bbox)
+
+    def add_layer(self):
+        bbox = self.doc.add_layer()
+        self.journal.record("layer_add", name=self.doc.layers[self.doc.active].name)
+        self.layer_changed(bbox)
+
+    def delete_layer(self):
+        if len(self.doc.layers) < 2:
+            return
+        name = self.doc.layers[self.doc.active].name
+        if not messagebox.askyesno("Delete Layer", f"Delete \"{name}\"? This cannot be undone."):
+            return
+        self.journal.record("layer_delete", index=self.doc.active)
+        self.layer_changed(self.doc.delete_layer(self.doc.active))
+
+    def move_layer(self, offset):
+        index = self.doc.active
+        bbox = self.doc.move_layer(index, offset)
+        if self.doc.active != index:
+            self.journal.record("layer_move", index=index, offset=offset)
+            self.layer_changed(bbox)
+
+    def on_layer_select(self, event):
+        selection = self.layer_list.curselection()
+        if not selection:
+            return
+        index = len(self.doc.layers) - 1 - selection[0]
+        if index != self.doc.active:
+            self.doc.select_layer(index)
+            self.journal.record("layer_select", index=index)
+            self.refresh_layers_panel()
+
+    def set_layer_visible(self):
+        visible = self.layer_visible.get()
+        bbox = self.doc.set_layer(self.doc.active, visible=visible)
+        if bbox:
+            self.journal.record("layer_set", index=self.doc.active, visible=visible)
+            self.layer_changed(bbox)
+
+    def set_layer_opacity(self, value):
+        opacity = int(value) / 100
+        bbox = self.doc.set_layer(self.doc.active, opacity=opacity)
+        if bbox:
+            self.journal.record("layer_set", index=self.doc.active, opacity=opacity)
+            self.saved = 0
+            self.update_canvas_image(bbox)
+
     def setup_bottom_panel(self):
         for widget in self.bottom_panel.winfo_children():
             widget.destroy()
 
         self.color_frame = tk.Frame(self.bottom_panel, bg="#ece9d8")
+        for c in self.colors:
+            tk.Button(self.color_frame, bg=c, width=2,
+                      command=lambda col=c: self.set_color(col)).pack(side=tk.LEFT, padx=1, pady=5)
         self.color_frame.pack(fill=tk.X, expand=True)
+        self.shown_panels = [self.color_frame]
+
+        self.fill_frame = tk.Frame(self.bottom_panel, bg="#ece9d8")
+        tk.Label(self.fill_frame, text="Tolerance:", bg="#ece9d8").pack(side=tk.LEFT, padx=(5, 0))
+        tk.Scale(self.fill_frame, from_=0, to=255, orient=tk.HORIZONTAL, variable=self.fill_tolerance,
+                 length=120, highlightthickness=0, bg="#ece9d8").pack(side=tk.LEFT)
+        tk.Checkbutton(self.fill_frame, text="8-way fill", variable=self.fill_connectivity,
+                       onvalue=8, offvalue=4, bg="#ece9d8").pack(side=tk.LEFT, padx=5)
+
+        self.spray_frame = tk.Frame(self.bottom_panel, bg="#ece9d8")
+        tk.Label(self.spray_frame, text="Density:", bg="#ece9d8").pack(side=tk.LEFT, padx=(5, 0))
+        tk.Scale(self.spray_frame, from_=1, to=50, orient=tk.HORIZONTAL, variable=self.spray_density,
+                 length=120, highlightthickness=0, bg="#ece9d8").pack(side=tk.LEFT)
+        tk.Label(self.spray_frame, text="Falloff:", bg="#ece9d8").pack(side=tk.LEFT, padx=(5, 0))
+        tk.Scale(self.spray_frame, from_=0.2, to=4.0, resolution=0.1, orient=tk.HORIZONTAL,
+                 variable=self.spray_falloff, length=120, highlightthickness=0, bg="#ece9d8").pack(side=tk.LEFT)
+
+        self.text_frame = tk.Frame(self.bottom_panel, bg="#ece9d8")
+        tk.Label(self.text_frame, text="Font:", bg="#ece9d8").pack(side=tk.LEFT, padx=(5, 0))
+        self.face_picker = ttk.Combobox(self.text_frame, textvariable=self.text_face, state="readonly", width=28)
+        self.face_picker.pack(side=tk.LEFT)
+        tk.Label(self.text_frame, text="Size:", bg="#ece9d8").pack(side=tk.LEFT, padx=(5, 0))
+        tk.Spinbox(self.text_frame, from_=8, to=200, textvariable=self.text_size, width=4).pack(side=tk.LEFT)
+        tk.Label(self.text_frame, text="Text:", bg="#ece9d8").pack(side=tk.LEFT, padx=(5, 0))
+        self.text_entry = tk.Entry(self.text_frame, textvariable=self.text_value, width=30)
+        self.text_entry.pack(side=tk.LEFT)
+        self.text_entry.bind("<Return>", lambda e: self.commit_text())
+        self.text_entry.bind("<Escape>", lambda e: self.cancel_text())
+        for var in (self.text_face, self.text_size, self.text_value):
+            var.trace_add("write", self.update_text_preview)
+
+        self.dab_frame = tk.Frame(self.bottom_panel, bg="#ece9d8")
+        for label, var, low, high, cmd in [
+                ("Size:", self.brush_size_var, 1, 100, lambda v: self.set_brush_size(int(float(v)))),
+                ("Hardness:", self.brush_hardness, 0, 100, None),
+                ("Spacing:", self.brush_spacing, 5, 100, None)]:
+            tk.Label(self.dab_frame, text=label, bg="#ece9d8").pack(side=tk.LEFT, padx=(5, 0))
+            tk.Scale(self.dab_frame, from_=low, to=high, orient=tk.HORIZONTAL, variable=var, command=cmd,
+                     length=100, highlightthickness=0, bg="#ece9d8").pack(side=tk.LEFT)
 
         self.eraser_frame = tk.Frame(self.bottom_panel, bg="#ece9d8")
 
@@ -223,31 +659,44 @@ class KP2:
                 bg="#ece9d8"
             ).pack(padx=5, pady=5)
 
+        # Stamp buttons are built the first time the stamp panel is shown
         self.stamps_frame = tk.Frame(self.bottom_panel, bg="#ece9d8")
+        self.stamps_built = False
 
-        self.stamp_photoimages = {}
-        for stamp_name, pil_img in self.stamp_images.items():
-            btn_img = pil_img.resize((32, 32))
-            photo_img = ImageTk.PhotoImage(btn_img)
-            self.stamp_photoimages[stamp_name] = photo_img
-            btn = tk.Button(self.stamps_frame, image=photo_img,
-                            command=lambda name=stamp_name: self.select_stamp(name), bg="#ece9d8")
-            btn.pack(side=tk.LEFT, padx=3, pady=5)
+        if self.color_icon:
+            tk.Button(self.bottom_panel, image=self.color_icon, command=self.ask_custom_color, bg="#ece9d8").pack(side=tk.RIGHT, padx=5, pady=5)
+        else:
+            tk.Button(self.bottom_panel, text="Custom Color", command=self.ask_custom_color, bg="#ece9d8").pack(side=tk.RIGHT, padx=5, pady=5)
 
+    def build_stamp_buttons(self):
+        # Built once; stamps added later get their button from add_stamp_button
         # Add button to load custom stamp
         add_stamp_icon = self.icons.get("addcustom")
         if add_stamp_icon:
-            add_stamp_btn = tk.Button(self.stamps_frame, image=add_stamp_icon,
-                                      command=self.add_custom_stamp, bg="#ece9d8")
+            self.add_stamp_btn = tk.Button(self.stamps_frame, image=add_stamp_icon,
+                                           command=self.add_custom_stamp, bg="#ece9d8")
         else:
-            add_stamp_btn = tk.Button(self.stamps_frame, text="+ Add Custom Stamp",
-                                      command=self.add_custom_stamp, bg="#ece9d8")
-        add_stamp_btn.pack(side=tk.LEFT, padx=5, pady=5)
+            self.add_stamp_btn = tk.Button(self.stamps_frame, text="+ Add Custom Stamp",
+                                           command=self.add_custom_stamp, bg="#ece9d8")
+        self.add_stamp_btn.pack(side=tk.LEFT, padx=5, pady=5)
+        tk.Checkbutton(self.stamps_frame, text="Follow brush size", variable=self.stamp_follow_brush,
+                       bg="#ece9d8").pack(side=tk.LEFT, padx=5)
 
-        if self.color_icon:
-            tk.Button(self.bottom_panel, image=self.color_icon, command=self.ask_custom_color, bg="#ece9d8").pack(side=tk.RIGHT, padx=5, pady=5)
-        else:
-            tk.Button(self.bottom_panel, text="Custom Color", command=self.ask_custom_color, bg="#ece9d8").pack(side=tk.RIGHT, padx=5, pady=5)
+        self.stamp_photoimages = {}
+        for stamp_name in self.stamp_files:
+            self.add_stamp_button(stamp_name)
+        self.stamps_built = True
+        self.stamp_cache.save_index()
+
+    def add_stamp_button(self, stamp_name):
+        thumb = self.get_stamp_thumbnail(stamp_name)
+        if thumb is None:
+            return
+        photo_img = ImageTk.PhotoImage(thumb)
+        self.stamp_photoimages[stamp_name] = photo_img
+        btn = tk.Button(self.stamps_frame, image=photo_img,
+                        command=lambda name=stamp_name: self.select_stamp(name), bg="#ece9d8")
+        btn.pack(side=tk.LEFT, padx=3, pady=5, before=self.add_stamp_btn)
 
     def add_custom_stamp(self):
         path = filedialog.askopenfilename(
@@ -257,20 +706,23 @@ class KP2:
         if not path:
             return
         try:
-            img = Image.open(path).convert("RGBA")
-            # Resize to max 64x64 keeping aspect ratio
-            img.thumbnail((64, 64), Image.LANCZOS)
-
             # Use file basename as key, add a number suffix if duplicate
             base_name = os.path.basename(path)
             name = base_name
             count = 1
-            while name in self.stamp_images:
+            while name in self.stamp_files:
                 name = f"{os.path.splitext(base_name)[0]}_{count}{os.path.splitext(base_name)[1]}"
                 count += 1
 
-            self.stamp_images[name] = img
-            self.update_bottom_panel()
+            # Keep a copy (max 64x64) in the cache so journaled stamps can be
+            # replayed; re-importing an unchanged file reuses it
+            stamp_path = self.stamp_cache.import_stamp(path, self.custom_stamps_dir, name)
+            if stamp_path in self.stamp_files.values():
+                name = next(n for n, p in self.stamp_files.items() if p == stamp_path)
+            else:
+                self.stamp_files[name] = stamp_path
+                if self.stamps_built:
+                    self.add_stamp_button(name)
             self.current_stamp = name
             self.use_stamps()
             messagebox.showinfo("Stamp Added", f"Custom stamp '{name}' added successfully!")
@@ -284,38 +736,86 @@ class KP2:
             self.set_color(color_code[1])
 
     def update_bottom_panel(self):
-        # Hide all frames first
-        for frame in [self.color_frame, self.eraser_frame, self.stamps_frame]:
-            frame.pack_forget()
+        # The panels are built once; a tool switch only re-packs them, and
+        # only if the tool needs different ones
+        if self.current_tool != "text":
+            self.cancel_text()
 
+        panels = []
         if self.current_tool in ["pen", "spray", "line", "square", "circle", "paintbucket", "text"]:
-            self.color_frame.pack(fill=tk.X, expand=True)
-            # Clear previous color buttons
-            for widget in self.color_frame.winfo_children():
-                widget.destroy()
-            # Add color buttons
-            for c in self.colors:
-                btn = tk.Button(self.color_frame, bg=c, width=2,
-                                command=lambda col=c: self.set_color(col))
-                btn.pack(side=tk.LEFT, padx=1, pady=5)
+            panels.append(self.color_frame)
+            if self.current_tool == "paintbucket":
+                panels.append(self.fill_frame)
+            elif self.current_tool == "spray":
+                panels.append(self.spray_frame)
+            elif self.current_tool == "pen":
+                panels.append(self.dab_frame)
+            elif self.current_tool == "text":
+                if not self.text_faces_loaded:
+                    self.face_picker["values"] = self.fonts.names()
+                    self.text_face.set(self.fonts.default_face() or "")
+                    self.text_faces_loaded = True
+                panels.append(self.text_frame)
         elif self.current_tool == "eraser":
-            self.eraser_frame.pack(fill=tk.X)
+            panels += [self.eraser_frame, self.dab_frame]
+        elif self.current_tool == "wand":
+            panels.append(self.fill_frame)
         elif self.current_tool == "stamps":
-            self.stamps_frame.pack(fill=tk.X)
+            if not self.stamps_built:
+                self.build_stamp_buttons()
+            panels.append(self.stamps_frame)
+        if panels == self.shown_panels:
+            return
+        for frame in self.shown_panels:
+            frame.pack_forget()
+        for frame in panels:
+            frame.pack(fill=tk.X, expand=frame is self.color_frame)
+        self.shown_panels = panels
 
     def select_stamp(self, name):
-        if name in self.stamp_images:
+        if name in self.stamp_files:
             self.current_stamp = name
 
     def create_menu(self):
         menubar = tk.Menu(self.root, bg="#ece9d8")
         file_menu = tk.Menu(menubar, tearoff=0, bg="#ece9d8")
         file_menu.add_command(label="New", command=self.new_canvas)
-        file_menu.add_command(label="Open", command=self.open_canvas)
+        file_menu.add_command(label="Open", command=lambda: self.open_canvas())
         file_menu.add_command(label="Save", command=self.normalsave_canvas)
         file_menu.add_command(label="Save As", command=self.save_canvas)
+        file_menu.add_command(label="Export PNG", command=self.export_png)
+        compression_menu = tk.Menu(file_menu, tearoff=0, bg="#ece9d8")
+        for label, level in [("Fast", 1), ("Balanced", 6), ("Small", 9)]:
+            compression_menu.add_radiobutton(label=label, variable=self.png_compression, value=level)
+        file_menu.add_cascade(label="PNG Compression", menu=compression_menu)
+        open_size_menu = tk.Menu(file_menu, tearoff=0, bg="#ece9d8")
+        for label, side in [("Full Size", 0), ("Fit 8192", 8192), ("Fit 4096", 4096), ("Fit 2048", 2048)]:
+            open_size_menu.add_radiobutton(label=label, variable=self.open_max_side, value=side)
+        file_menu.add_cascade(label="Open Large Images At", menu=open_size_menu)
         menubar.add_cascade(label="File", menu=file_menu)
+        view_menu = tk.Menu(menubar, tearoff=0, bg="#ece9d8")
+        view_menu.add_command(label="Zoom In", accelerator="Ctrl++", command=lambda: self.set_zoom(self.zoom_level + 1))
+        view_menu.add_command(label="Zoom Out", accelerator="Ctrl+-", command=lambda: self.set_zoom(self.zoom_level - 1))
+        view_menu.add_command(label="Actual Size", accelerator="Ctrl+0", command=lambda: self.set_zoom(0))
+        view_menu.add_command(label="Fit to Window", command=self.zoom_to_fit)
+        view_menu.add_separator()
+        view_menu.add_checkbutton(label="Performance Stats", variable=self.stats_visible, command=self.toggle_stats)
+        view_menu.add_command(label="Export Stats...", command=self.export_stats)
+        menubar.add_cascade(label="View", menu=view_menu)
+        select_menu = tk.Menu(menubar, tearoff=0, bg="#ece9d8")
+        select_menu.add_command(label="Select All", command=lambda: self.set_selection(
+            "rect", coords=[0, 0, self.doc.width, self.doc.height]))
+        select_menu.add_command(label="Deselect", command=lambda: self.set_selection("none"))
+        menubar.add_cascade(label="Select", menu=select_menu)
+        filter_menu = tk.Menu(menubar, tearoff=0, bg="#ece9d8")
+        filter_menu.add_command(label="Gaussian Blur...", command=self.blur_filter)
+        filter_menu.add_command(label="Sharpen", command=lambda: self.run_filter("sharpen", "Sharpen"))
+        filter_menu.add_command(label="Brightness/Contrast...", command=self.brightness_contrast_filter)
+        filter_menu.add_command(label="Invert", command=lambda: self.run_filter("invert", "Invert"))
+        filter_menu.add_command(label="Posterize...", command=self.posterize_filter)
+        menubar.add_cascade(label="Filters", menu=filter_menu)
         help_menu = tk.Menu(menubar, tearoff=0, bg="#ece9d8")
+        help_menu.add_command(label="Startup Times", command=self.show_startup_profile)
         help_menu.add_command(label="About", command=lambda: messagebox.showinfo(
             "About", "Craftsman Beta\nVersion: 0.9.0\nCreated by: Daniel Armstrong\n(C)2025 Daniel Armstrong"))
         menubar.add_cascade(label="Help", menu=help_menu)
@@ -330,13 +830,22 @@ class KP2:
                 dummyvalue = 69
             elif response is None:  # Cancel
                 return  # or whatever you want to do for cancel
-        self.image = Image.new("RGBA", (self.image_width, self.image_height), "white")
-        self.draw = ImageDraw.Draw(self.image)
+        width = simpledialog.askinteger("New", "Canvas width:", initialvalue=self.image_width,
+                                        minvalue=1, maxvalue=65536)
+        if not width:
+            return
+        height = simpledialog.askinteger("New", "Canvas height:", initialvalue=self.image_height,
+                                         minvalue=1, maxvalue=65536)
+        if not height:
+            return
+        self.image_width, self.image_height = width, height
+        self.doc.new(width, height)
+        self.view_x = self.view_y = 0
         self.update_canvas_image()
-        self.undo_stack.clear()
-        self.redo_stack.clear()
-        self.save_undo()
+        self.refresh_layers_panel()
+        self.journal.start(self.doc.snapshot())
         self.curpath = "NULL"
+        self.project = None
         self.saved = 1
         
     def open_canvas(self):
@@ -348,45 +857,219 @@ class KP2:
                 dummyvalue = 69
             elif response is None:  # Cancel
                 return  # or whatever you want to do for cancel
-        path = filedialog.askopenfilename(filetypes=[("Portable Network Graphics", "*.png")])
+        path = filedialog.askopenfilename(filetypes=[("Projects and images", " ".join(("*" + EXTENSION,) + FORMATS)),
+                                                     ("Craftsman projects", "*" + EXTENSION),
+                                                     ("Portable Network Graphics", "*.png"),
+                                                     ("All files", "*.*")])
         if not path:
             return
-        try:
-            img = Image.open(path).convert("RGBA")
-            self.curpath = path
-            self.saved = 1
-        except Exception as e:
-            messagebox.showerror("Open Error", f"Cannot open image:\n{e}")
+        if path.lower().endswith(EXTENSION):
+            # Only the index is read; tiles are decoded as they come into view
+            try:
+                project, layers = Project.open(path)
+            except (OSError, ValueError) as e:
+                messagebox.showerror("Open Error", f"Cannot open project:\n{e}")
+                return
+            self.finish_open(path, layers, project)
             return
-
-        # Resize image with aspect ratio and center it
-        img.thumbnail((self.image_width, self.image_height), Image.LANCZOS)
-        new_img = Image.new("RGBA", (self.image_width, self.image_height), "white")
-        offset = ((self.image_width - img.width) // 2, (self.image_height - img.height) // 2)
-        new_img.paste(img, offset)
-        self.image = new_img
-        self.draw = ImageDraw.Draw(self.image)
+        # Decoded in the background; a preview stands in until it is done
+        self.loading = True
+        self.loader.open(path, self.open_max_side.get() or None)
+        self.set_status(f"Opening {os.path.basename(path)}...")
+        self.root.after(30, self.poll_loads)
+
+    def poll_loads(self):
+        for ticket, kind, path, payload, seconds in self.loader.poll():
+            if ticket != self.loader.current:
+                continue
+            if kind == "preview":
+                self.show_placeholder(*payload)
+            elif kind == "done":
+                if self.stats.enabled:
+                    self.stats.record("load_image", seconds)
+                self.finish_open(path, payload)
+            else:
+                self.loading = False
+                self.clear_placeholder()
+                self.set_status("")
+                messagebox.showerror("Open Error", f"Cannot open image:\n{payload}")
+        if self.loading:
+            self.root.after(30, self.poll_loads)
+
+    def show_placeholder(self, preview, size):
+        # Lays the preview out where the image will appear: from the top
+        # left at the current zoom, cropped to the window
+        zoom = 2 ** self.zoom_level
+        scale = preview.width / size[0]
+        w = min(size[0], self.view_width / zoom)
+        h = min(size[1], self.view_height / zoom)
+        part = preview.crop((0, 0, max(1, round(w * scale)), max(1, round(h * scale))))
+        part = part.resize((max(1, round(w * zoom)), max(1, round(h * zoom))), Image.BILINEAR)
+        self.placeholder_photo = ImageTk.PhotoImage(part)
+        self.clear_placeholder()
+        self.placeholder_item = self.canvas.create_image(0, 0, anchor="nw", image=self.placeholder_photo)
+
+    def clear_placeholder(self):
+        if self.placeholder_item is not None:
+            self.canvas.delete(self.placeholder_item)
+            self.placeholder_item = None
+
+    def finish_open(self, path, surface, project=None):
+        self.loading = False
+        # Only projects and PNGs can be saved back in place
+        self.curpath = path if path.lower().endswith((".png", EXTENSION)) else "NULL"
+        self.project = project
+        self.saved = 1
+        if project is not None:
+            self.doc.restore(surface)
+        else:
+            self.doc.load(surface)
+        self.view_x = self.view_y = 0
         self.update_canvas_image()
-        self.undo_stack.clear()
-        self.redo_stack.clear()
+        self.clear_placeholder()
+        self.placeholder_photo = None
+        self.refresh_layers_panel()
+        self.journal.start(self.doc.snapshot())
+        self.set_status(f"Opened {os.path.basename(path)} ({surface.width} x {surface.height})")
+
+    def blur_filter(self):
+        radius = simpledialog.askfloat("Gaussian Blur", "Radius (pixels):", initialvalue=2.0,
+                                       minvalue=0.1, maxvalue=100)
+        if radius:
+            self.run_filter("blur", "Blur", radius=radius)
+
+    def brightness_contrast_filter(self):
+        brightness = simpledialog.askinteger("Brightness/Contrast", "Brightness (-100 to 100):",
+                                             initialvalue=0, minvalue=-100, maxvalue=100)
+        if brightness is None:
+            return
+        contrast = simpledialog.askinteger("Brightness/Contrast", "Contrast (-99 to 99):",
+                                           initialvalue=0, minvalue=-99, maxvalue=99)
+        if contrast is None:
+            return
+        self.run_filter("brightness_contrast", "Brightness/Contrast", brightness=brightness, contrast=contrast)
+
+    def posterize_filter(self):
+        bits = simpledialog.askinteger("Posterize", "Bits per channel (1 to 7):", initialvalue=3,
+                                       minvalue=1, maxvalue=7)
+        if bits:
+            self.run_filter("posterize", "Posterize", bits=bits)
+
+    def run_filter(self, name, label, **params):
+        # Filters the active layer, or just the selection and as much around
+        # it as the filter reads; the snapshot keeps the pixels the workers
+        # see fixed while the UI stays live
+        if self.loading or self.filtering:
+            return
+        selection = self.doc.selection
+        if selection is None:
+            source, origin = self.doc.surface.snapshot(), None
+        else:
+            margin = halo(name, params)
+            x0, y0, x1, y1 = selection.bbox
+            origin = clip_bbox((x0 - margin, y0 - margin, x1 + margin, y1 + margin), self.doc.width, self.doc.height)
+            source = self.doc.surface.crop(origin)
+        self.filtering = (self.doc.layers[self.doc.active], label, origin)
+        self.filters.start(source, name, params)
+        self.set_status(f"{label}... (Esc to cancel)")
+        self.root.after(50, self.poll_filters)
+
+    def cancel_filter(self):
+        if self.filtering:
+            self.filters.cancel()
+
+    def poll_filters(self):
+        layer, label, origin = self.filtering
+        for message in self.filters.poll():
+            if message[0] == "progress":
+                self.set_status(f"{label} {message[1]}/{message[2]} tiles (Esc to cancel)")
+                continue
+            self.filtering = None
+            if message[0] == "done":
+                self.finish_filter(layer, label, message[1], origin)
+            elif message[0] == "cancelled":
+                self.set_status(f"{label} cancelled")
+            else:
+                self.set_status("")
+                messagebox.showerror("Filter Error", f"{label} failed:\n{message[1]}")
+            return
+        self.root.after(50, self.poll_filters)
+
+    def finish_filter(self, layer, label, image, origin):
+        if layer not in self.doc.layers:
+            self.set_status(f"{label} discarded, its layer is gone")
+            return
+        index = self.doc.layers.index(layer)
+        if index != self.doc.active:
+            self.doc.select_layer(index)
+            self.journal.record("layer_select", index=index)
+            self.refresh_layers_panel()
+        # One patch, so one undo step
+        if origin is None:
+            bbox = self.doc.patch(image, (0, 0))
+        else:
+            x0, y0, x1, y1 = self.doc.selection.bbox
+            image = image.crop((x0 - origin[0], y0 - origin[1], x1 - origin[0], y1 - origin[1]))
+            bbox = self.doc.patch(image, (x0, y0), masked=True)
+        self.journal.record("patch", x=bbox[0], y=bbox[1], layer=index, image=self.doc.surface.crop(bbox))
+        self.update_canvas_image(bbox)
         self.save_undo()
+        self.saved = 0
+        self.set_status(f"{label} done")
+
     def save_canvas(self):
-        path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG files", "*.png")])
+        path = filedialog.asksaveasfilename(defaultextension=EXTENSION,
+                                            filetypes=[("Craftsman projects", "*" + EXTENSION),
+                                                       ("PNG files", "*.png")])
         if path: 
-            try:
-                self.image.save(path, "PNG")
-                self.curpath = path
-            except Exception as e:
-                messagebox.showerror("Save Error", f"Cannot save image:\n{e}")
+            self.write_image(path)
+            self.curpath = path
+
+    def export_png(self):
+        path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG files", "*.png")])
+        if path:
+            self.write_image(path, export=True)
 
     def normalsave_canvas(self):
         if (self.curpath == "NULL"):
             self.save_canvas()
         else:
-            try:
-                self.image.save(self.curpath, "PNG")
-            except Exception as e:
-                messagebox.showerror("Save Error", f"Cannot save image:\n{e}")
+            self.write_image(self.curpath)
+
+    def write_image(self, path, export=False):
+        # The snapshot is encoded in the background while drawing continues.
+        # A project only writes the tiles changed since it was last saved.
+        project = None
+        if path.lower().endswith(EXTENSION):
+            if self.project is None or self.project.path != path:
+                self.project = Project(path)
+            project = self.project
+        self.saver.save(self.doc.snapshot(), path, self.png_compression.get(), project)
+        if not export:
+            self.saved = 1
+        self.set_status(f"Saving {os.path.basename(path)}...")
+        if self.save_poll_job is None:
+            self.save_poll_job = self.root.after(100, self.poll_saves)
+
+    def poll_saves(self):
+        self.save_poll_job = None
+        self.report_saves(self.saver.poll())
+        if self.saver.busy():
+            self.save_poll_job = self.root.after(100, self.poll_saves)
+
+    def report_saves(self, results):
+        for path, error, seconds in results:
+            if error is None:
+                if self.stats.enabled:
+                    self.stats.record("save_image", seconds)
+                self.set_status(f"Saved {os.path.basename(path)}")
+            else:
+                self.saved = 0
+                self.set_status(f"Could not save {os.path.basename(path)}")
+                messagebox.showerror("Save Error", f"Cannot save image:\n{error}")
+
+    def set_status(self, text):
+        self.status.config(text=text)
 
 
     # TOOL SELECTORS
@@ -399,205 +1082,504 @@ class KP2:
     def use_text(self): self.current_tool = "text"; self.update_bottom_panel()
     def use_stamps(self): self.current_tool = "stamps"; self.update_bottom_panel()
     def use_eraser(self): self.current_tool = "eraser"; self.update_bottom_panel()
+    def use_select(self): self.current_tool = "select"; self.update_bottom_panel()
+    def use_wand(self): self.current_tool = "wand"; self.update_bottom_panel()
 
     def set_brush_size(self, size):
         self.brush_size = size
+        if self.brush_size_var.get() != size:
+            self.brush_size_var.set(size)
 
     def set_color(self, color):
         self.current_color = color
+        self.update_text_preview()
 
     def load_stamps(self):
-        self.stamp_images = {}
+        self.stamp_files = {}
         for file in os.listdir(self.stamps_dir):
             if file.lower().endswith((".png")):
-                try:
-                    img = Image.open(os.path.join(self.stamps_dir, file)).convert("RGBA")
-                    self.stamp_images[file] = img
-                except Exception:
-                    pass
+                self.stamp_files[file] = os.path.join(self.stamps_dir, file)
+
+    def stamp_size(self):
+        # None keeps stamps at their own size
+        if not self.stamp_follow_brush.get():
+            return None
+        if self.brush_size < 5:
+            return 32
+        return 64 if self.brush_size < 10 else 128
+
+    def get_stamp(self, name, size=None):
+        if name not in self.stamp_files:
+            return None
+        return self.stamp_cache.get(self.stamp_files[name], size)
+
+    def get_stamp_thumbnail(self, name):
+        return self.stamp_cache.thumbnail(self.stamp_files[name])
+
+    def doc_pos(self, event):
+        zoom = 2 ** self.zoom_level
+        return self.view_x + int(event.x / zoom), self.view_y + int(event.y / zoom)
+
+    def canvas_pos(self, x, y):
+        zoom = 2 ** self.zoom_level
+        return (x - self.view_x) * zoom, (y - self.view_y) * zoom
 
     def on_button_press(self, event):
+        if self.loading or self.filtering:
+            return
         self.saved = 0
-        self.last_x, self.last_y = event.x, event.y
-        self.start_x, self.start_y = event.x, event.y
+        x, y = self.doc_pos(event)
+        self.last_x, self.last_y = x, y
+        self.start_x, self.start_y = x, y
         if self.current_tool == "paintbucket":
-            self.paint_bucket(event.x, event.y)
-            self.apply_stamp(event.x, event.y)
-            player = vlc.MediaPlayer("audio/paintbucket.wav")
-            player.play()
+            self.paint_bucket(x, y)
+            self.apply_stamp(x, y)
+            self.sound.play("paintbucket")
+            self.save_undo()
         elif self.current_tool == "text":
-            self.insert_text(event.x, event.y)
-            self.apply_stamp(event.x, event.y)
-            player = vlc.MediaPlayer("audio/text.wav")
-            player.play()
+            self.place_text(x, y)
+        elif self.current_tool == "wand":
+            self.magic_wand(x, y)
         elif self.current_tool == "stamps" and self.current_stamp:
-            self.apply_stamp(event.x, event.y)
-            player = vlc.MediaPlayer("audio/stamp.wav")
-            player.play()
+            self.apply_stamp(x, y)
+            self.sound.play("stamp")
             self.save_undo()
         elif self.current_tool == "eraser":
-            self.erase(event.x, event.y)
-            self.save_undo()
+            self.brush = self.new_brush(erase=True)
+            bbox = self.erase([(x, y)])
+            if bbox:
+                self.update_canvas_image(bbox)
         elif self.current_tool == "pen":
-            self.draw.line([(self.last_x, self.last_y), (event.x, event.y)], fill=self.current_color, width=self.brush_size)
-            self.update_canvas_image()
-            player = vlc.MediaPlayer("audio/pen.wav")
-            player.play()
-            player.get_media().add_option("input-repeat=-1")
+            self.brush = self.new_brush()
+            bbox = self.draw_polyline([(x, y)])
+            if bbox:
+                self.update_canvas_image(bbox)
+            self.sound.play("pen", loop=True)
         elif self.current_tool == "spray":
-            self.spray(event.x, event.y)
-            self.update_canvas_image()
-            player = vlc.MediaPlayer("audio/spray.wav")
-            player.play()
-            player.get_media().add_option("input-repeat=-1")
+            # Each stroke gets its own seed so it can be replayed exactly
+            import numpy as np
+            self.spray_seed = random.getrandbits(32)
+            self.spray_rng = np.random.default_rng(self.spray_seed)
+            bbox = self.spray(x, y)
+            if bbox:
+                self.update_canvas_image(bbox)
+            self.sound.play("spray", loop=True)
             
 
 
     def on_paint(self, event):
+        if self.loading or self.filtering:
+            return
+        x, y = self.doc_pos(event)
+        if self.current_tool in ["pen", "spray", "eraser"]:
+            self.pending_points.append((x, y))
+            if self.frame_job is None:
+                self.frame_job = self.root.after(self.frame_interval, self.flush_frame)
+        elif self.current_tool in ["line", "square", "circle", "select"]:
+            self.draw_preview(x, y)
+
+    def flush_frame(self):
+        # Draws everything queued since the last frame, then refreshes the
+        # display once for the combined dirty region
+        if self.frame_job is not None:
+            self.root.after_cancel(self.frame_job)
+            self.frame_job = None
+        points, self.pending_points = self.pending_points, []
+        if not points:
+            return
+        bbox = None
         if self.current_tool == "pen":
-            self.draw.line([(self.last_x, self.last_y), (event.x, event.y)], fill=self.current_color, width=self.brush_size)
-            self.last_x, self.last_y = event.x, event.y
-            self.update_canvas_image()
+            if self.last_x is not None:
+                points.insert(0, (self.last_x, self.last_y))
+            bbox = self.draw_polyline(points)
         elif self.current_tool == "spray":
-            self.spray(event.x, event.y)
-            self.update_canvas_image()
-        else:
-            # For shape tools, draw a preview
-            self.draw_preview(event.x, event.y)
+            for x, y in points:
+                bbox = union_bbox(bbox, self.spray(x, y))
+        elif self.current_tool == "eraser":
+            if self.last_x is not None:
+                points.insert(0, (self.last_x, self.last_y))
+            bbox = self.erase(points)
+        self.last_x, self.last_y = points[-1]
+        if bbox:
+            self.update_canvas_image(bbox)
 
     def on_button_release(self, event):
+        if self.loading or self.filtering:
+            return
+        self.flush_frame()
         if self.current_tool in ["line", "square", "circle"]:
-            self.draw_shape(self.start_x, self.start_y, event.x, event.y)
-            self.update_canvas_image()
-            self.save_undo()
-        elif self.current_tool == "pen":
-            self.save_undo()
-        elif self.current_tool == "spray":
-            self.save_undo()
-        elif self.current_tool == "eraser":
-            self.save_undo()
+            self.clear_preview()
+            x, y = self.doc_pos(event)
+            # Nothing to redraw when the shape misses the selection
+            bbox = self.draw_shape(self.start_x, self.start_y, x, y)
+            if bbox:
+                self.update_canvas_image(bbox)
+            self.sound.play("shape")
+        elif self.current_tool == "select":
+            self.clear_preview()
+            x, y = self.doc_pos(event)
+            if (x, y) == (self.start_x, self.start_y):
+                self.set_selection("none")  # a click clears the selection
+            else:
+                self.set_selection("rect", coords=[min(x, self.start_x), min(y, self.start_y),
+                                                   max(x, self.start_x) + 1, max(y, self.start_y) + 1])
+        elif self.current_tool in ["pen", "spray"]:
+            self.sound.stop_loop()
+        self.log_stroke()
+        # One history entry per stroke; a no-op if the stroke changed nothing
+        self.save_undo()
 
         self.last_x = self.last_y = None
         self.start_x = self.start_y = None
-        self.temp_preview_image = None
 
     def draw_preview(self, x, y):
-        # Draw a temporary preview on canvas for shapes without affecting the image
-        if self.temp_preview_image:
-            self.canvas.delete(self.temp_preview_image)
-        preview_img = self.image.copy()
-        preview_draw = ImageDraw.Draw(preview_img)
-        if self.current_tool == "line":
-            preview_draw.line([(self.start_x, self.start_y), (x, y)], fill=self.current_color, width=self.brush_size)
+        # Preview shapes with a native canvas item that is only moved on
+        # drag; the shape is rasterized into the image once, on release
+        coords = self.canvas_pos(self.start_x, self.start_y) + self.canvas_pos(x, y)
+        width = max(1, self.brush_size * 2 ** self.zoom_level)
+        if self.preview_item is not None:
+            self.canvas.coords(self.preview_item, *coords)
+        elif self.current_tool == "line":
+            self.preview_item = self.canvas.create_line(*coords, fill=self.current_color,
+                                                        width=width, capstyle=tk.ROUND)
         elif self.current_tool == "square":
-            preview_draw.rectangle([self.start_x, self.start_y, x, y], outline=self.current_color, width=self.brush_size)
+            self.preview_item = self.canvas.create_rectangle(*coords, outline=self.current_color,
+                                                             width=width)
         elif self.current_tool == "circle":
-            preview_draw.ellipse([self.start_x, self.start_y, x, y], outline=self.current_color, width=self.brush_size)
-        tk_img = ImageTk.PhotoImage(preview_img)
-        self.temp_preview_image = self.canvas.create_image(0, 0, anchor="nw", image=tk_img)
-        self.canvas.image = tk_img  # keep reference
+            self.preview_item = self.canvas.create_oval(*coords, outline=self.current_color,
+                                                        width=width)
+        elif self.current_tool == "select":
+            self.preview_item = self.canvas.create_rectangle(*coords, outline="black", dash=(4, 4))
+
+    def clear_preview(self):
+        if self.preview_item is not None:
+            self.canvas.delete(self.preview_item)
+            self.preview_item = None
+
+    def new_brush(self, erase=False):
+        # The eraser's size has always been a radius
+        size = 2 * self.brush_size + 1 if erase else self.brush_size
+        return Brush(size, self.current_color, self.brush_hardness.get() / 100,
+                     self.brush_spacing.get() / 100, erase)
+
+    def draw_polyline(self, points):
+        self.stroke_log.append(points)
+        return self.doc.paint(self.brush, points)
 
     def draw_shape(self, x1, y1, x2, y2):
-        if self.current_tool == "line":
-            self.draw.line([(x1, y1), (x2, y2)], fill=self.current_color, width=self.brush_size)
-        elif self.current_tool == "square":
-            self.draw.rectangle([x1, y1, x2, y2], outline=self.current_color, width=self.brush_size)
-        elif self.current_tool == "circle":
-            self.draw.ellipse([x1, y1, x2, y2], outline=self.current_color, width=self.brush_size)
-        self.player = vlc.MediaPlayer("audio/shape.wav")
-        self.player.play()
+        self.journal.record("shape", kind=self.current_tool, coords=[x1, y1, x2, y2],
+                            color=self.current_color, width=self.brush_size)
+        return self.doc.shape(self.current_tool, x1, y1, x2, y2, self.current_color, self.brush_size)
 
     def spray(self, x, y):
-        for _ in range(self.brush_size * 10):
-            angle = random.uniform(0, 2 * math.pi)
-            radius = random.uniform(0, self.brush_size)
-            dx = int(radius * math.cos(angle))
-            dy = int(radius * math.sin(angle))
-            px, py = x + dx, y + dy
-            if 0 <= px < self.image_width and 0 <= py < self.image_height:
-                self.draw.point((px, py), fill=self.current_color)
+        self.stroke_log.append((x, y))
+        return self.doc.spray(x, y, self.current_color, self.brush_size, self.spray_rng,
+                              self.spray_density.get(), self.spray_falloff.get())
+
+    def magic_wand(self, x, y):
+        # Same reach as the paint bucket: the visible area on huge canvases
+        limit = None
+        if self.doc.width * self.doc.height > self.max_fill_pixels:
+            limit = self.visible_bbox()
+        self.set_selection("wand", x=x, y=y, tolerance=self.fill_tolerance.get(),
+                           connectivity=self.fill_connectivity.get(), limit=limit)
+
+    def set_selection(self, kind, **args):
+        # kind is "rect" (coords), "wand" (x, y, tolerance, connectivity,
+        # limit) or "none"; journaled so replays clip the same way
+        if self.filtering:
+            return
+        if kind == "rect":
+            self.doc.select_rect(args["coords"])
+        elif kind == "wand":
+            self.doc.select_wand(args["x"], args["y"], args["tolerance"], args["connectivity"], args["limit"])
+        else:
+            self.doc.select_none()
+        self.journal.record("select", kind=kind, **args)
+        self.show_selection()
+
+    def show_selection(self):
+        # Outlines the selection over the image: its bounding box dashed,
+        # and for a wand selection the edge of the part in view
+        self.canvas.delete("selection")
+        self.selection_photo = None
+        selection = self.doc.selection
+        if selection is None:
+            return
+        x0, y0 = self.canvas_pos(*selection.bbox[:2])
+        x1, y1 = self.canvas_pos(*selection.bbox[2:])
+        for color, offset in (("black", 0), ("white", 4)):
+            self.canvas.create_rectangle(x0, y0, x1, y1, outline=color, dash=(4, 4), dashoffset=offset,
+                                         tags="selection")
+        bbox = intersect_bbox(selection.bbox, self.visible_bbox())
+        if selection.mask is None or bbox is None:
+            return
+        edges = selection.edges(bbox)
+        if self.zoom_level > 0:
+            zoom = 2 ** self.zoom_level
+            edges = edges.resize((edges.width * zoom, edges.height * zoom), Image.NEAREST)
+        elif self.zoom_level < 0:
+            # Any edge pixel in a reduced pixel keeps it, so thin edges survive
+            edges = edges.reduce(2 ** -self.zoom_level).point(lambda v: 255 if v else 0)
+        overlay = Image.new("RGBA", edges.size, (0, 0, 0, 0))
+        overlay.paste((0, 0, 0, 255), (0, 0) + edges.size, edges)
+        self.selection_photo = ImageTk.PhotoImage(overlay)
+        self.canvas.create_image(*self.canvas_pos(bbox[0], bbox[1]), anchor="nw", image=self.selection_photo,
+                                 tags="selection")
 
     def paint_bucket(self, x, y):
-        target_color = self.image.getpixel((x, y))
-        fill_color = ImageColor.getrgb(self.current_color)
-
-        if target_color[:3] == fill_color[:3]:
-            return  # no need to fill if same color
-
-        pixels = self.image.load()
-        width, height = self.image.size
-        edge = [(x, y)]
-        while edge:
-            nx, ny = edge.pop()
-            if 0 <= nx < width and 0 <= ny < height:
-                current_color = pixels[nx, ny]
-                if current_color[:3] == target_color[:3]:
-                    pixels[nx, ny] = fill_color + (255,)
-                    edge.extend([(nx+1, ny), (nx-1, ny), (nx, ny+1), (nx, ny-1)])
-
-        self.update_canvas_image()
-        self.save_undo()
-
-    def insert_text(self, x, y):
-        text = simpledialog.askstring("Text", "Enter text:")
-        if not text: return
-        size = simpledialog.askinteger("Text Tool", "Enter text size:", minvalue=8, maxvalue=200)
-        if not size: return
-
+        tolerance, connectivity = self.fill_tolerance.get(), self.fill_connectivity.get()
+        limit = None
+        if self.doc.width * self.doc.height > self.max_fill_pixels:
+            limit = self.visible_bbox()
+        bbox = self.doc.fill(x, y, self.current_color, tolerance, connectivity, limit)
+        if bbox:
+            self.journal.record("fill", x=x, y=y, color=self.current_color,
+                                tolerance=tolerance, connectivity=connectivity, limit=limit)
+            self.update_canvas_image(bbox)
+        return bbox
+
+    def text_font(self):
         try:
-            font = ImageFont.truetype("arial.ttf", size)
-        except:
-            try:
-                font = ImageFont.truetype("DejaVuSans.ttf", size)
-            except:
-                font = ImageFont.load_default()
-
-        bbox = self.draw.textbbox((0, 0), text, font=font)
+            size = max(8, min(self.text_size.get(), 200))
+        except tk.TclError:
+            return None, None
+        face = self.text_face.get() or None
+        return self.fonts.font(face, size), size
+
+    def place_text(self, x, y):
+        self.text_anchor = (x, y)
+        self.text_entry.focus_set()
+        self.update_text_preview()
+
+    def update_text_preview(self, *args):
+        # Renders the pending text with the cached font and shows it as a
+        # canvas item; nothing touches the document until Enter
+        if self.text_anchor is None:
+            return
+        text = self.text_value.get()
+        font, size = self.text_font()
+        if not text or font is None:
+            self.clear_text_preview()
+            return
+        pos, bbox = text_layout(*self.text_anchor, text, font)
         w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
-        self.draw.text((x - w // 2, y - h // 2), text, fill=self.current_color, font=font)
-        self.update_canvas_image()
+        if w <= 0 or h <= 0:
+            self.clear_text_preview()
+            return
+        image = Image.new("RGBA", (w, h), ImageColor.getrgb(self.current_color)[:3] + (0,))
+        ImageDraw.Draw(image).text((pos[0] - bbox[0], pos[1] - bbox[1]), text, fill=self.current_color, font=font)
+        if self.zoom_level:
+            zoom = 2 ** self.zoom_level
+            image = image.resize((max(1, int(w * zoom)), max(1, int(h * zoom))),
+                                 Image.NEAREST if zoom > 1 else Image.BOX)
+        self.text_preview_photo = ImageTk.PhotoImage(image)
+        x, y = self.canvas_pos(bbox[0], bbox[1])
+        if self.text_preview_item is None:
+            self.text_preview_item = self.canvas.create_image(x, y, anchor="nw", image=self.text_preview_photo)
+        else:
+            self.canvas.coords(self.text_preview_item, x, y)
+            self.canvas.itemconfig(self.text_preview_item, image=self.text_preview_photo)
+
+    def clear_text_preview(self):
+        if self.text_preview_item is not None:
+            self.canvas.delete(self.text_preview_item)
+            self.text_preview_item = None
+            self.text_preview_photo = None
+
+    def cancel_text(self):
+        self.text_anchor = None
+        self.clear_text_preview()
+
+    def commit_text(self):
+        text = self.text_value.get()
+        if self.text_anchor is None or not text:
+            return
+        x, y = self.text_anchor
+        self.cancel_text()
+        self.insert_text(x, y, text)
+        self.apply_stamp(x, y)
+        self.sound.play("text")
+        self.save_undo()
+        self.text_value.set("")
 
+    def insert_text(self, x, y, text):
+        font, size = self.text_font()
+        if font is None:
+            return
+        face = self.text_face.get() or None
+        bbox = self.doc.text(x, y, text, font, self.current_color)
+        self.journal.record("text", x=x, y=y, text=text, face=face, size=size, color=self.current_color)
+        if bbox:
+            self.update_canvas_image(bbox)
+        return bbox
 
     def apply_stamp(self, x, y):
-        if not self.current_stamp or self.current_stamp not in self.stamp_images:
+        size = self.stamp_size()
+        stamp = self.get_stamp(self.current_stamp, size) if self.current_stamp else None
+        if stamp is None:
             return
-        stamp = self.stamp_images[self.current_stamp]
-        w, h = stamp.size
-        pos = (x - w // 2, y - h // 2)
-        self.image.paste(stamp, pos, stamp)
-        self.update_canvas_image()
-
-    def erase(self, x, y):
-        bbox = [x - self.brush_size, y - self.brush_size, x + self.brush_size, y + self.brush_size]
-        self.draw.ellipse(bbox, fill="white")
-        self.update_canvas_image()
-
-    def update_canvas_image(self):
-        self.img_for_tk = ImageTk.PhotoImage(self.image)
+        image, mask = stamp
+        bbox = self.doc.stamp(image, x, y, mask)
+        self.journal.record("stamp", path=self.stamp_files[self.current_stamp], x=x, y=y, size=size)
+        if bbox:
+            self.update_canvas_image(bbox)
+        return bbox
+
+    def erase(self, points):
+        self.stroke_log.append(points)
+        return self.doc.paint(self.brush, points)
+
+    def log_stroke(self):
+        log, self.stroke_log = self.stroke_log, []
+        if not log:
+            return
+        if self.current_tool in ("pen", "eraser"):
+            brush = self.brush
+            self.journal.record("paint", segments=log, color=brush.color, size=brush.size,
+                                hardness=brush.hardness, spacing=brush.spacing, erase=brush.erase)
+        elif self.current_tool == "spray":
+            self.journal.record("spray", points=log, seed=self.spray_seed, color=self.current_color,
+                                radius=self.brush_size, density=self.spray_density.get(),
+                                falloff=self.spray_falloff.get())
+
+    def visible_bbox(self):
+        zoom = 2 ** self.zoom_level
+        return (self.view_x, self.view_y,
+                min(self.view_x + math.ceil(self.view_width / zoom), self.doc.width),
+                min(self.view_y + math.ceil(self.view_height / zoom), self.doc.height))
+
+    def view_image(self, bbox):
+        # Renders a document region at the current zoom. Returns the image
+        # and where it goes on the canvas.
+        level = self.zoom_level
+        if level < 0:
+            s = 2 ** -level
+            box = (bbox[0] // s, bbox[1] // s, -(-bbox[2] // s), -(-bbox[3] // s))
+            return self.doc.reduced(-level, box), (box[0] - self.view_x // s, box[1] - self.view_y // s)
+        image = self.doc.crop(bbox)
+        if level > 0:
+            zoom = 2 ** level
+            image = image.resize((image.width * zoom, image.height * zoom), Image.NEAREST)
+        return image, self.canvas_pos(bbox[0], bbox[1])
+
+    def redraw_view(self):
+        # Rebuilds the display image for the visible part of the document
+        zoom = 2 ** self.zoom_level
+        self.view_x = max(0, min(self.view_x, self.doc.width - int(self.view_width / zoom)))
+        self.view_y = max(0, min(self.view_y, self.doc.height - int(self.view_height / zoom)))
+        if self.zoom_level < 0:
+            # Keep the origin on a whole pixel of the reduced level
+            step = 2 ** -self.zoom_level
+            self.view_x -= self.view_x % step
+            self.view_y -= self.view_y % step
+        image, _ = self.view_image(self.visible_bbox())
+        self.img_for_tk = ImageTk.PhotoImage(image)
         self.canvas.itemconfig(self.image_on_canvas, image=self.img_for_tk)
         self.canvas.image = self.img_for_tk  # keep reference
+        self.update_text_preview()
+        self.show_selection()
+        x0, y0, x1, y1 = self.visible_bbox()
+        self.hscroll.set(x0 / self.doc.width, x1 / self.doc.width)
+        self.vscroll.set(y0 / self.doc.height, y1 / self.doc.height)
+
+    def update_canvas_image(self, bbox=None):
+        # Only the visible part of the dirty region is converted and copied
+        # into the persistent PhotoImage; bbox=None redraws the viewport.
+        if bbox is None:
+            self.redraw_view()
+            return
+        bbox = intersect_bbox(bbox, self.visible_bbox())
+        if bbox is None:
+            return
+        image, (x, y) = self.view_image(bbox)
+        patch = ImageTk.PhotoImage(image)
+        self.canvas.tk.call(str(self.img_for_tk), "copy", str(patch),
+                            "-to", x, y, "-compositingrule", "set")
+
+    def scroll_position(self, args, pos, page, total):
+        if args[0] == "moveto":
+            pos = int(float(args[1]) * total)
+        elif args[0] == "scroll":
+            step = int(page * 0.9) if args[2] == "pages" else max(1, int(40 / 2 ** self.zoom_level))
+            pos += int(args[1]) * step
+        return max(0, min(pos, total - page))
+
+    def scroll_x(self, *args):
+        page = int(self.view_width / 2 ** self.zoom_level)
+        self.view_x = self.scroll_position(args, self.view_x, page, self.doc.width)
+        self.redraw_view()
+
+    def scroll_y(self, *args):
+        page = int(self.view_height / 2 ** self.zoom_level)
+        self.view_y = self.scroll_position(args, self.view_y, page, self.doc.height)
+        self.redraw_view()
+
+    def set_zoom(self, level, cx=None, cy=None):
+        # Zooms about canvas point (cx, cy), the centre by default
+        level = max(self.min_zoom, min(level, self.max_zoom))
+        if level == self.zoom_level:
+            return
+        if cx is None:
+            cx, cy = self.view_width // 2, self.view_height // 2
+        x = self.view_x + cx / 2 ** self.zoom_level
+        y = self.view_y + cy / 2 ** self.zoom_level
+        self.zoom_level = level
+        self.view_x = int(x - cx / 2 ** level)
+        self.view_y = int(y - cy / 2 ** level)
+        self.redraw_view()
+        self.set_status(f"Zoom {2 ** level * 100:g}%")
+
+    def zoom_to_fit(self):
+        level = 0
+        while level > self.min_zoom and (self.doc.width > self.view_width * 2 ** -level or
+                                         self.doc.height > self.view_height * 2 ** -level):
+            level -= 1
+        self.set_zoom(level)
+
+    def on_pan_start(self, event):
+        self.pan_start = (event.x, event.y, self.view_x, self.view_y)
+
+    def on_pan(self, event):
+        if self.pan_start is None:
+            return
+        x, y, view_x, view_y = self.pan_start
+        zoom = 2 ** self.zoom_level
+        self.view_x = view_x - int((event.x - x) / zoom)
+        self.view_y = view_y - int((event.y - y) / zoom)
+        self.redraw_view()
+
+    def on_canvas_resize(self, event):
+        if (event.width, event.height) != (self.view_width, self.view_height):
+            self.view_width, self.view_height = event.width, event.height
+            self.redraw_view()
 
     def save_undo(self):
-        if len(self.undo_stack) >= 20:
-            self.undo_stack.popleft()
-        self.undo_stack.append(self.image.copy())
-        self.redo_stack.clear()
+        if self.doc.commit() and self.journal.needs_checkpoint():
+            self.journal.start(self.doc.snapshot(), self.doc.selection)
 
     def undo(self):
-        if self.undo_stack:
-            last = self.undo_stack.pop()
-            self.redo_stack.append(self.image.copy())
-            self.image = last
-            self.draw = ImageDraw.Draw(self.image)
-            self.update_canvas_image()
+        if self.filtering:
+            return
+        bbox = self.doc.undo()
+        if bbox:
+            self.journal_patch(bbox)
+            self.update_canvas_image(bbox)
 
     def redo(self):
-        if self.redo_stack:
-            last = self.redo_stack.pop()
-            self.undo_stack.append(self.image.copy())
-            self.image = last
-            self.draw = ImageDraw.Draw(self.image)
-            self.update_canvas_image()
+        if self.filtering:
+            return
+        bbox = self.doc.redo()
+        if bbox:
+            self.journal_patch(bbox)
+            self.update_canvas_image(bbox)
+
+    def journal_patch(self, bbox):
+        bbox = clip_bbox(bbox, self.doc.width, self.doc.height)
+        for index, layer in enumerate(self.doc.layers):
+            if layer.surface in self.doc.history.swapped:
+                self.journal.record("patch", x=bbox[0], y=bbox[1], layer=index,
+                                    image=layer.surface.crop(bbox))
 
     def on_close(self):
         try:
@@ -613,7 +1595,18 @@ class KP2:
                 dummyvalue = 69
         except:
             dummyvalue = 69
-        os.rmdir("cache")
+        if self.saver.busy():
+            self.set_status("Finishing saves...")
+            self.root.update_idletasks()
+        results = self.saver.close()
+        self.report_saves(results)
+        if any(error is not None for _, error, _ in results):
+            return  # keep the window open so the work isn't lost
+        self.filters.close()
+        self.sound.close()
+        # A clean exit leaves nothing to recover (imported stamps included)
+        self.journal.close(discard=True)
+        self.stamp_cache.save_index()
         self.root.destroy()
 
 
@@ -0,0 +1,220 @@
+# Headless batch mode: applies a script of drawing operations to many
+# images without opening a window, e.g. to watermark a folder with a stamp
+# or annotate screenshots. Work is spread over a process pool; each worker
+# writes its own results straight to disk and the parent only collects
+# timings and errors.
+#
+#   python batch.py script.json shots/ extra.png -o out/ -j 8 --report times.csv
+#
+# The script is a JSON list of operations in the same form the journal
+# uses, for example
+#   [{"op": "stamp", "path": "stamps/sun.png", "x": -40, "y": -40},
+#    {"op": "text", "x": 100, "y": 20, "text": "DRAFT", "size": 32, "color": "#FF0000"}]
+# Negative x/y values count back from the right/bottom edge. Results keep
+# their file names; inputs that share a name keep the part of their path
+# that tells them apart (a/x.png and b/x.png -> out/a/x.png, out/b/x.png).
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+from engine import Document
+from fonts import FontRegistry
+from journal import replay
+from stamps import StampCache
+
+# op -> the keys replay() needs
+OPS = {
+    "paint": ("segments", "size", "hardness", "spacing"),
+    "stroke": ("segments", "color", "width"),
+    "spray": ("points", "seed", "color", "radius", "density", "falloff"),
+    "erase": ("points", "radius"),
+    "fill": ("x", "y", "color", "tolerance", "connectivity"),
+    "shape": ("kind", "coords", "color", "width"),
+    "text": ("x", "y", "text", "size", "color"),
+    "stamp": ("path", "x", "y"),
+    "patch": ("png", "x", "y"),
+    "select": ("kind",),
+    "layer_add": ("name",),
+    "layer_delete": ("index",),
+    "layer_move": ("index", "offset"),
+    "layer_select": ("index",),
+    "layer_set": ("index",),
+}
+SELECT_KINDS = {"rect": ("coords",), "wand": ("x", "y", "tolerance", "connectivity"), "mask": ("coords", "png"),
+                "none": ()}
+IMAGE_TYPES = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+
+# Per-process state, set up once by init_worker
+worker = {}
+
+
+def load_script(path):
+    with open(path, encoding="utf-8") as f:
+        ops = json.load(f)
+    if not isinstance(ops, list):
+        raise ValueError("script must be a JSON list of operations")
+    for i, op in enumerate(ops):
+        if not isinstance(op, dict) or op.get("op") not in OPS:
+            raise ValueError(f"operation {i + 1}: unknown op {op.get('op') if isinstance(op, dict) else op!r}")
+        required = OPS[op["op"]]
+        if op["op"] == "select":
+            if op.get("kind") not in SELECT_KINDS:
+                raise ValueError(f"operation {i + 1}: unknown selection kind {op.get('kind')!r}")
+            required += SELECT_KINDS[op["kind"]]
+        missing = [key for key in required if key not in op]
+        if missing:
+            raise ValueError(f"operation {i + 1} ({op['op']}): missing {', '.join(missing)}")
+    return ops
+
+
+def list_images(sources):
+    # Files, directories (their images, sorted) and @lists of paths
+    for source in sources:
+        if source.startswith("@"):
+            with open(source[1:], encoding="utf-8") as f:
+                yield from (line.strip() for line in f if line.strip())
+        elif os.path.isdir(source):
+            for file in sorted(os.listdir(source)):
+                if file.lower().endswith(IMAGE_TYPES):
+                    yield os.path.join(source, file)
+        else:
+            yield source
+
+
+def output_names(paths):
+    # path -> output path relative to the output directory: the file name,
+    # or for names used more than once, the path below their common parent
+    by_name = {}
+    for path in paths:
+        by_name.setdefault(os.path.normcase(os.path.basename(path)), []).append(path)
+    names = {}
+    for same in by_name.values():
+        if len(same) == 1:
+            names[same[0]] = os.path.basename(same[0])
+            continue
+        full = [os.path.abspath(path) for path in same]
+        parent = os.path.commonpath([os.path.dirname(path) for path in full])
+        for path, absolute in zip(same, full):
+            names[path] = os.path.relpath(absolute, parent)
+    return names
+
+
+def resolve(op, width, height):
+    # Negative coordinates are measured from the right/bottom edge
+    def point(x, y):
+        return (x + width if x < 0 else x, y + height if y < 0 else y)
+
+    op = dict(op)
+    if "x" in op and "y" in op:
+        op["x"], op["y"] = point(op["x"], op["y"])
+    if "coords" in op:
+        op["coords"] = [*point(*op["coords"][:2]), *point(*op["coords"][2:])]
+    if "points" in op:
+        op["points"] = [point(x, y) for x, y in op["points"]]
+    if "segments" in op:
+        op["segments"] = [[point(x, y) for x, y in segment] for segment in op["segments"]]
+    return op
+
+
+def init_worker(ops, out_dir, cache_dir, compress_level):
+    worker.update(ops=ops, out_dir=out_dir, compress_level=compress_level,
+                  stamps=StampCache(cache_dir), fonts=FontRegistry(cache_dir))
+
+
+def process(path, name):
+    # Runs the script on one image, saving it as name in the output
+    # directory; returns (path, output, seconds, error)
+    start = time.perf_counter()
+    out = os.path.join(worker["out_dir"], name)
+    try:
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        with Image.open(path) as image:
+            fmt = image.format or "PNG"
+            doc = Document(1, 1)
+            doc.load(image.convert("RGBA"))
+        for op in worker["ops"]:
+            replay(doc, resolve(op, doc.width, doc.height), worker["stamps"].get, worker["fonts"].font)
+        result = doc.to_image()
+        if fmt in ("JPEG", "BMP"):
+            result = result.convert("RGB")
+        tmp = out + ".tmp"
+        try:
+            if fmt == "PNG":
+                result.save(tmp, fmt, compress_level=worker["compress_level"])
+            else:
+                result.save(tmp, fmt)
+            os.replace(tmp, out)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return path, out, time.perf_counter() - start, None
+    except Exception as e:
+        return path, None, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+
+
+def run(paths, ops, out_dir, jobs=None, cache_dir="cache", compress_level=6):
+    # Yields each result as it finishes; with jobs=1 everything runs in
+    # this process, which is easier to debug
+    os.makedirs(out_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    args = (ops, out_dir, cache_dir, compress_level)
+    names = output_names(paths)
+    if jobs == 1:
+        init_worker(*args)
+        for path in paths:
+            yield process(path, names[path])
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=args) as pool:
+        for future in as_completed([pool.submit(process, path, names[path]) for path in paths]):
+            yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply a Craftsman operation script to many images.")
+    parser.add_argument("script", help="JSON list of operations")
+    parser.add_argument("images", nargs="+", help="image files, directories or @file lists")
+    parser.add_argument("-o", "--out", default="out", help="output directory (default: out)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--compression", type=int, default=6, choices=range(10), metavar="0-9",
+                        help="PNG compression level (default: 6)")
+    parser.add_argument("--report", help="write per-file timings to this CSV file")
+    parser.add_argument("--cache", default="cache", help="stamp and font cache directory")
+    args = parser.parse_args(argv)
+
+    try:
+        ops = load_script(args.script)
+    except (OSError, ValueError) as e:
+        parser.error(f"{args.script}: {e}")
+    # The same file listed twice, however it is spelled, is done once
+    paths = list({os.path.abspath(path): path for path in list_images(args.images)}.values())
+    if not paths:
+        parser.error("no images to process")
+
+    start = time.perf_counter()
+    failed = 0
+    rows = []
+    for path, out, seconds, error in run(paths, ops, args.out, args.jobs, args.cache, args.compression):
+        rows.append((path, out or "", f"{seconds:.4f}", error or ""))
+        if error:
+            failed += 1
+            print(f"FAIL {seconds:7.3f}s {path}: {error}", flush=True)
+        else:
+            print(f"ok   {seconds:7.3f}s {path} -> {out}", flush=True)
+    total = time.perf_counter() - start
+    print(f"{len(paths) - failed}/{len(paths)} images in {total:.2f}s, {failed} failed")
+
+    if args.report:
+        with open(args.report, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["path", "output", "seconds", "error"])
+            writer.writerows(rows)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+# Benchmarks for the interactive paths. Each scenario runs in a fresh
+# process with sound off, under a virtual X display (Xvfb is started when
+# there is no DISPLAY, or always with --xvfb). It opens a real KP2 window,
+# feeds its mouse handlers a seeded stream of synthetic events and reports
+# events per second, handler latency and peak RSS. Motion is normally
+# drawn by a frame timer that batches everything queued within 16 ms; here
+# each motion's frame is drawn straight away (flush_frame), so an event's
+# latency is its handler, its own drawing and the display update, and
+# doesn't depend on how fast the events are replayed.
+#
+#   python bench.py                                  # every scenario -> bench.json
+#   python bench.py pen bucket -n 5 -o new.json --baseline bench.json
+#   python bench.py --events scribble.json           # a recorded stream
+#
+# A recorded stream is a JSON file such as
+#   {"tool": "pen", "size": 5, "events": [["press", 10, 10], ["motion", 12, 11], ["release", 12, 11]]}
+# Events may also be ["color", "#FF0000"], ["tool", "line"], ["undo"] or ["redo"].
+# With --baseline, a scenario whose events/sec drops or whose p99 latency
+# rises by more than --threshold percent is reported and the exit code is 1.
+from types import SimpleNamespace
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Files KP2 reads from its working directory
+ASSETS = ("icon.png", "stamps", "gui")
+
+
+def scribble(rng, width, height, strokes, length, step=6):
+    # Random-walk strokes: press, length motions, release
+    events = []
+    for _ in range(strokes):
+        x, y = rng.randrange(width), rng.randrange(height)
+        events.append(("press", x, y))
+        for _ in range(length):
+            x = min(width - 1, max(0, x + rng.randint(-step, step)))
+            y = min(height - 1, max(0, y + rng.randint(-step, step)))
+            events.append(("motion", x, y))
+        events.append(("release", x, y))
+    return events
+
+
+def clicks(rng, width, height, count, colors=None):
+    events = []
+    for i in range(count):
+        if colors:
+            events.append(("color", colors[i % len(colors)]))
+        x, y = rng.randrange(width), rng.randrange(height)
+        events += [("press", x, y), ("release", x, y)]
+    return events
+
+
+def drags(rng, width, height, count, steps=40):
+    events = []
+    for i in range(count):
+        events.append(("tool", ("line", "square", "circle")[i % 3]))
+        x0, y0, x1, y1 = (rng.randrange(width), rng.randrange(height), rng.randrange(width), rng.randrange(height))
+        events.append(("press", x0, y0))
+        for s in range(1, steps + 1):
+            events.append(("motion", x0 + (x1 - x0) * s // steps, y0 + (y1 - y0) * s // steps))
+        events.append(("release", x1, y1))
+    return events
+
+
+def churn(rng, width, height, rounds, depth=20):
+    # Strokes to build up history, then undo and redo through it
+    events = scribble(rng, width, height, depth, 30, step=12)
+    for _ in range(rounds):
+        events += [("undo",)] * depth + [("redo",)] * depth
+    return events
+
+
+# name -> (tool, brush size, setup options, events(rng, width, height))
+SCENARIOS = {
+    "pen": ("pen", 5, {}, lambda rng, w, h: scribble(rng, w, h, 40, 150)),
+    "spray": ("spray", 40, {"spray_density": 40}, lambda rng, w, h: scribble(rng, w, h, 10, 200, step=10)),
+    "bucket": ("paintbucket", 3, {}, lambda rng, w, h: clicks(rng, w, h, 60, ["#FF3300", "#003399", "#FFFF00"])),
+    "shapes": ("line", 4, {}, lambda rng, w, h: drags(rng, w, h, 60)),
+    "stamp": ("stamps", 20, {}, lambda rng, w, h: clicks(rng, w, h, 300)),
+    "undo": ("pen", 12, {}, lambda rng, w, h: churn(rng, w, h, 10)),
+}
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(sorted_ms, p):
+    if not sorted_ms:
+        return 0
+    return round(sorted_ms[min(len(sorted_ms) - 1, int(p * len(sorted_ms)))], 3)
+
+
+def drive(app, root, tool, size, options, events):
+    # Returns the latency of every event in milliseconds
+    for name, value in options.items():
+        getattr(app, name).set(value)
+    app.brush_size = size
+    app.brush_size_var.set(size)
+    app.current_tool = tool
+    if tool == "stamps":
+        app.current_stamp = next(iter(app.stamp_files), None)
+    app.update_bottom_panel()
+    root.update()
+    handlers = {"press": app.on_button_press, "motion": app.on_paint, "release": app.on_button_release}
+    times = []
+    for event in events:
+        kind = event[0]
+        start = time.perf_counter()
+        if kind in handlers:
+            handlers[kind](SimpleNamespace(x=event[1], y=event[2], state=0))
+        elif kind == "color":
+            app.set_color(event[1])
+        elif kind == "tool":
+            app.current_tool = event[1]
+        elif kind == "undo":
+            app.undo()
+        elif kind == "redo":
+            app.redo()
+        else:
+            raise ValueError(f"unknown event {event!r}")
+        if kind == "motion":
+            app.flush_frame()
+        root.update()
+        if kind in handlers or kind in ("undo", "redo"):
+            times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def run_scenario(name, width, height, seed, events_file=None):
+    # Runs in the child process, inside a scratch copy of the assets
+    from Craftsman import KP2
+    import tkinter as tk
+
+    if events_file:
+        with open(events_file, encoding="utf-8") as f:
+            recorded = json.load(f)
+        tool, size, options, events = recorded["tool"], recorded.get("size", 3), {}, recorded["events"]
+    else:
+        tool, size, options, make = SCENARIOS[name]
+        events = make(random.Random(seed), width, height)
+    random.seed(seed)  # the spray tool seeds each stroke from here
+
+    root = tk.Tk()
+    root.geometry(f"{width + 200}x{height + 250}")
+    app = KP2(root, sound=False)
+    app.image_width, app.image_height = width, height
+    app.doc.new(width, height)
+    app.view_x = app.view_y = 0
+    app.update_canvas_image()
+    app.journal.start(app.doc.snapshot())
+    root.update()
+    setup_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    times = drive(app, root, tool, size, options, events)
+    wall = time.perf_counter() - start
+
+    app.journal.close(discard=True)
+    app.saver.close()
+    app.filters.close()
+    root.destroy()
+    busy = sum(times) / 1000
+    times.sort()
+    return {"events": len(times), "seconds": round(wall, 4),
+            "events_per_sec": round(len(times) / busy, 1) if busy else 0,
+            "mean_ms": round(statistics.fmean(times), 3) if times else 0,
+            "p50_ms": percentile(times, 0.5), "p99_ms": percentile(times, 0.99),
+            "max_ms": round(times[-1], 3) if times else 0,
+            "setup_rss_mb": setup_rss, "peak_rss_mb": peak_rss_mb()}
+
+
+def start_xvfb():
+    # Returns (process, display); the first free display number from :99 up
+    xvfb = shutil.which("Xvfb")
+    if xvfb is None:
+        raise SystemExit("bench: no DISPLAY and Xvfb is not installed")
+    number = next(n for n in range(99, 200) if not os.path.exists(f"/tmp/.X{n}-lock"))
+    proc = subprocess.Popen([xvfb, f":{number}", "-screen", "0", "1920x1200x24", "-nolisten", "tcp"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(f"/tmp/.X11-unix/X{number}"):
+        if proc.poll() is not None or time.monotonic() > deadline:
+            proc.kill()
+            raise SystemExit("bench: Xvfb did not start")
+        time.sleep(0.05)
+    return proc, f":{number}"
+
+
+def run_child(name, args, env):
+    # Each run gets its own process, so peak RSS and caches are its own
+    with tempfile.TemporaryDirectory(prefix="craftsman-bench-") as scratch:
+        for asset in ASSETS:
+            source = os.path.join(HERE, asset)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(scratch, asset))
+            elif os.path.exists(source):
+                shutil.copy(source, scratch)
+        command = [sys.executable, os.path.abspath(__file__), "--child", name, "--size", args.size,
+                   "--seed", str(args.seed)]
+        if args.events:
+            command += ["--events", os.path.abspath(args.events)]
+        result = subprocess.run(command, cwd=scratch, env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"{name} failed:\n{result.stderr.strip()}")
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    # Median of each figure over the repeats
+    summary = {}
+    for key in runs[0]:
+        values = [run[key] for run in runs if run[key] is not None]
+        summary[key] = round(statistics.median(values), 3) if values else None
+    summary["runs"] = len(runs)
+    return summary
+
+
+def compare(results, baseline, threshold):
+    # Prints the change from the baseline; returns the regressed scenarios
+    regressed = []
+    for name, new in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:10s} (not in baseline)")
+            continue
+        line = [f"{name:10s}"]
+        worse = False
+        for key, higher_is_better in (("events_per_sec", True), ("p50_ms", False), ("p99_ms", False),
+                                      ("peak_rss_mb", False)):
+            if not old.get(key) or new.get(key) is None:
+                continue
+            change = (new[key] - old[key]) / old[key] * 100
+            line.append(f"{key} {old[key]:g} -> {new[key]:g} ({change:+.1f}%)")
+            if key in ("events_per_sec", "p99_ms") and (-change if higher_is_better else change) > threshold:
+                worse = True
+        if worse:
+            regressed.append(name)
+            line.append("REGRESSED")
+        print("  ".join(line))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Craftsman's drawing handlers.")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="runs per scenario (default: 3)")
+    parser.add_argument("--size", default="800x600", help="canvas size (default: 800x600)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the synthetic events (default: 1)")
+    parser.add_argument("--events", help="run a recorded event stream instead")
+    parser.add_argument("-o", "--out", default="bench.json", help="results file (default: bench.json)")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent change that counts as a regression (default: 10)")
+    parser.add_argument("--xvfb", action="store_true", help="use a new Xvfb display even if DISPLAY is set")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    try:
+        width, height = (int(v) for v in args.size.lower().split("x"))
+    except ValueError:
+        parser.error(f"bad --size {args.size!r}, expected WIDTHxHEIGHT")
+
+    if args.child:
+        sys.path.insert(0, HERE)
+        print(json.dumps(run_scenario(args.child, width, height, args.seed, args.events)))
+        return 0
+
+    if args.events:
+        names = [os.path.splitext(os.path.basename(args.events))[0]]
+    else:
+        names = args.scenarios or list(SCENARIOS)
+        unknown = [name for name in names if name not in SCENARIOS]
+        if unknown:
+            parser.error(f"unknown scenario {unknown[0]!r}; choose from {', '.join(SCENARIOS)}")
+
+    env = dict(os.environ)
+    xvfb = None
+    if args.xvfb or (sys.platform.startswith("linux") and not env.get("DISPLAY")):
+        xvfb, env["DISPLAY"] = start_xvfb()
+    try:
+        results = {}
+        for name in names:
+            runs = [run_child(name, args, env) for _ in range(args.repeat)]
+            results[name] = summarize(runs)
+            r = results[name]
+            print(f"{name:10s} {r['events']:6g} events  {r['events_per_sec']:9.1f}/s  p50 {r['p50_ms']:7.3f} ms  "
+                  f"p99 {r['p99_ms']:8.3f} ms  peak {r['peak_rss_mb']} MB", flush=True)
+    except RuntimeError as e:
+        print(f"bench: {e}", file=sys.stderr)
+        return 2
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+
+    meta = {"python": platform.python_version(), "platform": platform.platform(), "machine": platform.machine(),
+            "cpus": os.cpu_count(), "size": args.size, "seed": args.seed, "repeat": args.repeat,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    try:
+        meta["commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                                        text=True).stdout.strip() or None
+    except OSError:
+        pass
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "scenarios": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["scenarios"]
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
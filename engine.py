@@ -0,0 +1,930 @@
+# Headless drawing engine. Nothing in here imports tkinter or VLC, so the
+# same operations can drive the Tk UI, batch jobs and profiling harnesses.
+from PIL import Image, ImageChops, ImageDraw, ImageColor, ImageFilter, ImageFont
+from collections import deque
+from functools import lru_cache
+import math
+
+
+def union_bbox(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def clip_bbox(bbox, width, height):
+    # Bounding boxes are (x0, y0, x1, y1) with x1/y1 exclusive, like Image.crop
+    x0, y0, x1, y1 = bbox
+    x0, y0 = max(0, int(math.floor(x0))), max(0, int(math.floor(y0)))
+    x1, y1 = min(width, int(math.ceil(x1))), min(height, int(math.ceil(y1)))
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (x0, y0, x1, y1)
+
+
+def intersect_bbox(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (x0, y0, x1, y1)
+
+
+def points_bbox(points, pad):
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs) - pad, min(ys) - pad, max(xs) + pad + 1, max(ys) + pad + 1)
+
+
+def flood_fill_mask(image, x, y, tolerance=0, connectivity=4, within=None):
+    # Scanline flood fill over a NumPy view of the image. Returns a mask of
+    # the filled pixels cropped to their bounding box, plus that bbox. The
+    # fill never spreads outside within, a mask the size of image.
+    import numpy as np
+    arr = np.asarray(image)
+    height, width = arr.shape[:2]
+    if tolerance:
+        match = np.ones((height, width), dtype=bool)
+        for c in range(4):
+            channel = arr[..., c].astype(np.int16)
+            match &= np.abs(channel - int(arr[y, x, c])) <= tolerance
+    else:
+        # Compare whole pixels as uint32, alpha included: on a transparent
+        # layer (0, 0, 0, 0) is not the same colour as opaque black
+        packed = arr.view(np.uint32).reshape(height, width)
+        match = packed == packed[y, x]
+    if within is not None:
+        match &= np.asarray(within) > 0
+    reach = 1 if connectivity == 8 else 0
+    runs = {}
+
+    def row_runs(ry):
+        # Starts, (exclusive) ends and done flags of the matching runs in a
+        # row, found once per row; a fill always covers whole runs
+        if ry not in runs:
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], match[ry].view(np.int8), [0]))))
+            runs[ry] = (edges[0::2], edges[1::2], np.zeros(len(edges) // 2, dtype=bool))
+        return runs[ry]
+
+    # Each stack item is a row and the runs in it reached so far, so the
+    # Python loop runs once per batch of runs rather than once per run
+    stack = []
+    if match[y, x]:
+        starts = row_runs(y)[0]
+        stack.append((y, np.searchsorted(starts, [x], "right") - 1))
+    while stack:
+        sy, new = stack.pop()
+        starts, ends, done = row_runs(sy)
+        new = np.unique(new[~done[new]])
+        if not len(new):
+            continue
+        done[new] = True
+        lo = np.maximum(starts[new] - reach, 0)
+        hi = np.minimum(ends[new] + reach, width)
+        for ny in (sy - 1, sy + 1):
+            if 0 <= ny < height:
+                # The runs overlapping each lo..hi, by binary search
+                nstarts, nends, ndone = row_runs(ny)
+                first = np.searchsorted(nends, lo, "right")
+                count = np.searchsorted(nstarts, hi, "left") - first
+                total = int(count.sum())
+                if total:
+                    hit = np.arange(total) + np.repeat(first - np.cumsum(count) + count, count)
+                    stack.append((ny, hit[~ndone[hit]]))
+    filled = np.zeros((height, width), dtype=bool)
+    min_x, min_y, max_x, max_y = x, y, x, y
+    for ry, (starts, ends, done) in runs.items():
+        if done.any():
+            starts, ends = starts[done], ends[done]
+            # Runs never touch, so each boundary is set once
+            edges = np.zeros(width + 1, dtype=np.int8)
+            edges[starts] = 1
+            edges[ends] = -1
+            filled[ry] = np.cumsum(edges[:-1]) > 0
+            min_x, max_x = min(min_x, int(starts[0])), max(max_x, int(ends[-1]) - 1)
+            min_y, max_y = min(min_y, ry), max(max_y, ry)
+    bbox = (int(min_x), int(min_y), int(max_x) + 1, int(max_y) + 1)
+    mask = filled[bbox[1]:bbox[3], bbox[0]:bbox[2]]
+    return Image.fromarray(mask.astype(np.uint8) * 255, "L"), bbox
+
+
+def spray_points(rng, x, y, radius, density=10, falloff=1.0, width=None, height=None):
+    # Generates a whole burst of spray dots at once. density is dots per
+    # pixel of radius; falloff > 1 concentrates dots towards the centre.
+    import numpy as np
+    count = max(1, int(radius * density))
+    angle = rng.uniform(0, 2 * np.pi, count)
+    dist = radius * rng.random(count) ** falloff
+    px = x + (dist * np.cos(angle)).astype(np.intp)
+    py = y + (dist * np.sin(angle)).astype(np.intp)
+    if width is not None and height is not None:
+        keep = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+        px, py = px[keep], py[keep]
+    return np.column_stack((px, py))
+
+
+@lru_cache(maxsize=64)
+def dab_mask(diameter, hardness=1.0):
+    # Antialiased round brush tip as an "L" mask, centred on its middle
+    # pixel. Hardness 1 is a solid disc; lower values fade out from
+    # hardness * radius to the rim.
+    import numpy as np
+    r = diameter / 2
+    c = int(math.ceil(r))
+    yy, xx = np.mgrid[-c:c + 1, -c:c + 1]
+    d = np.hypot(xx, yy)
+    alpha = np.clip(r + 0.5 - d, 0, 1)
+    if hardness < 1:
+        t = np.clip((r - d) / (r * (1 - hardness)), 0, 1)
+        alpha *= t * t * (3 - 2 * t)
+    return Image.fromarray((alpha * 255 + 0.5).astype(np.uint8), "L")
+
+
+def dab_positions(points, step, residual=None):
+    # Evenly spaced points along a polyline. residual is the distance still
+    # to go before the next dab, carried over between calls so a stroke
+    # drawn in pieces is spaced exactly like one drawn at once; None starts
+    # a stroke with a dab on its first point.
+    dabs = []
+    if residual is None:
+        dabs.append(points[0])
+        residual = step
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        length = math.hypot(x1 - x0, y1 - y0)
+        if length == 0:
+            continue
+        d = residual
+        while d <= length:
+            t = d / length
+            dabs.append((x0 + (x1 - x0) * t, y0 + (y1 - y0) * t))
+            d += step
+        residual = d - length
+    return dabs, residual
+
+
+class Brush:
+    # A round brush for the pen and eraser: size is the tip diameter,
+    # spacing the distance between dabs as a fraction of it. Holds the
+    # spacing carried over between the pieces of one stroke.
+    def __init__(self, size, color="black", hardness=1.0, spacing=0.15, erase=False):
+        self.size = max(1, size)
+        self.color = color
+        self.hardness = hardness
+        self.spacing = spacing
+        self.erase = erase
+        self.residual = None
+
+    @property
+    def step(self):
+        return max(1.0, self.spacing * self.size)
+
+
+class TiledImage:
+    # An RGBA raster stored as fixed-size tiles. Tiles are allocated the first
+    # time they are drawn on; missing tiles read as the background colour,
+    # so memory grows with the painted area rather than the canvas size.
+    # Tile objects may be shared with history entries and snapshots, so a
+    # shared tile is copied before it is written (copy-on-write). A tile may
+    # also be a stand-in with a decode() method (see project.py), turned
+    # into pixels the first time it is read.
+    def __init__(self, width, height, background="white", tile_size=128):
+        self.width, self.height = width, height
+        self.tile_size = tile_size
+        if isinstance(background, str):
+            background = ImageColor.getrgb(background)
+        self.background = tuple(background[:3]) + ((background[3],) if len(background) > 3 else (255,))
+        self.tiles = {}
+        self.shared = set()
+
+    @classmethod
+    def from_image(cls, image, background="white", tile_size=128):
+        # Converted tile by tile, so a big image is never copied whole
+        surface = cls(image.width, image.height, background, tile_size)
+        surface.paste(image, (0, 0))
+        return surface
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    def tile_box(self, key):
+        ts = self.tile_size
+        tx, ty = key
+        return (tx * ts, ty * ts, min((tx + 1) * ts, self.width), min((ty + 1) * ts, self.height))
+
+    def tiles_in(self, bbox):
+        bbox = clip_bbox(bbox, self.width, self.height)
+        if bbox is None:
+            return []
+        ts = self.tile_size
+        return [(tx, ty)
+                for ty in range(bbox[1] // ts, (bbox[3] - 1) // ts + 1)
+                for tx in range(bbox[0] // ts, (bbox[2] - 1) // ts + 1)]
+
+    def get_tile(self, key):
+        return self.tiles.get(key)
+
+    def pixels(self, key):
+        tile = self.tiles.get(key)
+        if tile is not None and not isinstance(tile, Image.Image):
+            tile = self.tiles[key] = tile.decode()
+            # The file may know these pixels by identity, so never draw on them
+            self.shared.add(key)
+        return tile
+
+    def has_tiles(self, bbox):
+        # Whether any allocated tile overlaps bbox, without walking every
+        # key of a huge empty region
+        keys = self.tiles_in(bbox)
+        if len(keys) <= len(self.tiles):
+            return any(key in self.tiles for key in keys)
+        if not keys:
+            return False
+        (tx0, ty0), (tx1, ty1) = keys[0], keys[-1]
+        return any(tx0 <= tx <= tx1 and ty0 <= ty <= ty1 for tx, ty in self.tiles)
+
+    def set_tile(self, key, tile):
+        if tile is None:
+            self.tiles.pop(key, None)
+            self.shared.discard(key)
+        else:
+            self.tiles[key] = tile
+            self.shared.add(key)
+
+    def share(self, key):
+        if key in self.tiles:
+            self.shared.add(key)
+
+    def writable_tile(self, key):
+        tile = self.pixels(key)
+        if tile is None:
+            box = self.tile_box(key)
+            tile = self.tiles[key] = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), self.background)
+        elif key in self.shared:
+            tile = self.tiles[key] = tile.copy()
+            self.shared.discard(key)
+        return tile
+
+    def crop(self, bbox):
+        x0, y0, x1, y1 = bbox
+        region = Image.new("RGBA", (x1 - x0, y1 - y0), self.background)
+        for key in self.tiles_in(bbox):
+            tile = self.pixels(key)
+            if tile is not None:
+                box = self.tile_box(key)
+                region.paste(tile, (box[0] - x0, box[1] - y0))
+        return region
+
+    def paste(self, image, xy):
+        # Overwrites the pixels under image (no blending)
+        x, y = xy
+        for key in self.tiles_in((x, y, x + image.width, y + image.height)):
+            box = self.tile_box(key)
+            ix0, iy0 = max(box[0], x), max(box[1], y)
+            ix1, iy1 = min(box[2], x + image.width), min(box[3], y + image.height)
+            part = image.crop((ix0 - x, iy0 - y, ix1 - x, iy1 - y))
+            if part.mode != "RGBA":
+                part = part.convert("RGBA")
+            if (ix0, iy0, ix1, iy1) == box:
+                self.tiles[key] = part
+                self.shared.discard(key)
+            else:
+                self.writable_tile(key).paste(part, (ix0 - box[0], iy0 - box[1]))
+
+    def to_image(self):
+        return self.crop((0, 0, self.width, self.height))
+
+    def snapshot(self):
+        # A read-only copy that shares every tile with this surface
+        copy = TiledImage(self.width, self.height, self.background, self.tile_size)
+        copy.tiles = dict(self.tiles)
+        self.shared.update(self.tiles)
+        return copy
+
+    def nbytes(self):
+        return sum(tile.width * tile.height * 4 for tile in self.tiles.values())
+
+
+class Layer:
+    def __init__(self, surface, name="Layer", opacity=1.0, visible=True):
+        self.surface = surface
+        self.name = name
+        self.opacity = opacity
+        self.visible = visible
+
+    def snapshot(self):
+        return Layer(self.surface.snapshot(), self.name, self.opacity, self.visible)
+
+
+def faded(image, opacity):
+    if opacity >= 1:
+        return image
+    image.putalpha(image.getchannel("A").point(lambda a: int(a * opacity)))
+    return image
+
+
+class Composite:
+    # The flattened view of a layer stack. Everything below the active
+    # layer and everything above it are kept as two cached, tiled images,
+    # so drawing on the active layer only recomposites three surfaces in
+    # the dirty region however many layers there are. The caches only go
+    # stale when another layer changes (invalidate) or the stack does.
+    def __init__(self, layers, active=0):
+        self.layers = layers
+        self.active = active
+        first = layers[0].surface
+        self.width, self.height, self.tile_size = first.width, first.height, first.tile_size
+        self.below = TiledImage(self.width, self.height, (0, 0, 0, 0), self.tile_size)
+        self.above = TiledImage(self.width, self.height, (0, 0, 0, 0), self.tile_size)
+        self.valid = {self.below: set(), self.above: set()}
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def background(self):
+        # What unpainted areas look like once composited
+        pixel = Image.new("RGBA", (1, 1), (0, 0, 0, 0))
+        for layer in self.layers:
+            if layer.visible:
+                pixel.alpha_composite(faded(Image.new("RGBA", (1, 1), layer.surface.background), layer.opacity))
+        return pixel.getpixel((0, 0))
+
+    def invalidate(self, bbox=None):
+        for cache, valid in self.valid.items():
+            if bbox is None:
+                valid.clear()
+            else:
+                valid.difference_update(cache.tiles_in(bbox))
+
+    def has_tiles(self, bbox):
+        # False where every layer is unpainted, which composites to background
+        return any(layer.visible and layer.surface.has_tiles(bbox) for layer in self.layers)
+
+    def flatten(self, layers, bbox):
+        region = Image.new("RGBA", (bbox[2] - bbox[0], bbox[3] - bbox[1]), (0, 0, 0, 0))
+        for layer in layers:
+            if layer.visible and (layer.surface.background[3] or layer.surface.has_tiles(bbox)):
+                region.alpha_composite(faded(layer.surface.crop(bbox), layer.opacity))
+        return region
+
+    def cached(self, cache, layers, bbox):
+        valid = self.valid[cache]
+        for key in cache.tiles_in(bbox):
+            if key not in valid:
+                region = self.flatten(layers, cache.tile_box(key))
+                if region.getbbox() is None:
+                    cache.tiles.pop(key, None)
+                else:
+                    cache.tiles[key] = region
+                valid.add(key)
+        return cache.crop(bbox)
+
+    def crop(self, bbox):
+        layer = self.layers[self.active]
+        if len(self.layers) == 1 and layer.visible and layer.opacity >= 1:
+            return layer.surface.crop(bbox)
+        region = self.cached(self.below, self.layers[:self.active], bbox)
+        if layer.visible:
+            region.alpha_composite(faded(layer.surface.crop(bbox), layer.opacity))
+        if self.active + 1 < len(self.layers):
+            region.alpha_composite(self.cached(self.above, self.layers[self.active + 1:], bbox))
+        return region
+
+    def to_image(self):
+        return self.crop((0, 0, self.width, self.height))
+
+    def snapshot(self):
+        # Read-only copy of the stack, sharing every tile
+        return Composite([layer.snapshot() for layer in self.layers], self.active)
+
+
+class Pyramid:
+    # Cached half-size reductions of an image for zoomed-out views.
+    # Level n is 1/2**n of the full size and is built tile by tile from
+    # level n-1 the first time it is looked at. invalidate() only marks the
+    # tiles over a changed region stale, so after a stroke just those are
+    # rebuilt, and only once they are viewed again.
+    def __init__(self, surface):
+        self.surface = surface
+        self.levels = [surface]
+        self.valid = [None]
+
+    def level(self, n):
+        while len(self.levels) <= n:
+            below = self.levels[-1]
+            self.levels.append(TiledImage(-(-below.width // 2), -(-below.height // 2),
+                                          below.background, below.tile_size))
+            self.valid.append(set())
+        return self.levels[n]
+
+    def invalidate(self, bbox):
+        if bbox is None:
+            return
+        x0, y0, x1, y1 = bbox
+        for n in range(1, len(self.levels)):
+            s = 2 ** n
+            keys = self.levels[n].tiles_in((x0 // s, y0 // s, -(-x1 // s), -(-y1 // s)))
+            self.valid[n].difference_update(keys)
+
+    def build(self, n, bbox):
+        image, below = self.level(n), self.level(n - 1)
+        for key in image.tiles_in(bbox):
+            if key in self.valid[n]:
+                continue
+            x0, y0, x1, y1 = image.tile_box(key)
+            source = (2 * x0, 2 * y0, min(2 * x1, below.width), min(2 * y1, below.height))
+            # Areas that were never drawn on stay unallocated at every level
+            s = 2 ** n
+            if not self.surface.has_tiles((x0 * s, y0 * s, x1 * s, y1 * s)):
+                image.tiles.pop(key, None)
+            else:
+                if n > 1:
+                    self.build(n - 1, source)
+                image.tiles[key] = below.crop(source).reduce(2)
+            self.valid[n].add(key)
+
+    def crop(self, n, bbox):
+        # bbox is in level-n pixels
+        if n > 0:
+            self.build(n, bbox)
+        return self.level(n).crop(bbox)
+
+
+class TileHistory:
+    # Undo/redo history that only keeps the tiles a stroke changed. Each
+    # entry maps (surface, tile key) -> the tile as it was before the stroke
+    # (None for an unallocated tile); undoing swaps them with the current
+    # tiles, which become the redo entry. Tiles are shared with the surface
+    # rather than copied, which copies them lazily on the next write.
+    def __init__(self, budget=128 * 1024 * 1024):
+        self.budget = budget
+        self.undo_stack = deque()
+        self.redo_stack = deque()
+        self.pending = None
+        self.nbytes = 0
+        self.swapped = set()  # surfaces changed by the last undo or redo
+
+    def touch(self, surface, bbox):
+        # Must be called before drawing into bbox
+        if self.pending is None:
+            self.pending = {}
+        for key in surface.tiles_in(bbox):
+            if (surface, key) not in self.pending:
+                self.pending[surface, key] = surface.get_tile(key)
+                surface.share(key)
+
+    def commit(self):
+        entry, self.pending = self.pending, None
+        if not entry:
+            return False
+        self.undo_stack.append(entry)
+        self.nbytes += self.entry_bytes(entry)
+        for old in self.redo_stack:
+            self.nbytes -= self.entry_bytes(old)
+        self.redo_stack.clear()
+        self.evict()
+        return True
+
+    def entry_bytes(self, entry):
+        return sum(tile.width * tile.height * 4 for tile in entry.values() if tile is not None)
+
+    def evict(self):
+        while self.nbytes > self.budget and len(self.undo_stack) > 1:
+            self.nbytes -= self.entry_bytes(self.undo_stack.popleft())
+
+    def swap(self, entry):
+        swapped = {}
+        bbox = None
+        self.swapped = {surface for surface, key in entry}
+        for (surface, key), tile in entry.items():
+            swapped[surface, key] = surface.get_tile(key)
+            surface.set_tile(key, tile)
+            bbox = union_bbox(bbox, surface.tile_box(key))
+        self.nbytes += self.entry_bytes(swapped) - self.entry_bytes(entry)
+        return swapped, bbox
+
+    def undo(self):
+        self.commit()
+        if not self.undo_stack:
+            return None
+        entry, bbox = self.swap(self.undo_stack.pop())
+        self.redo_stack.append(entry)
+        return bbox
+
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        entry, bbox = self.swap(self.redo_stack.pop())
+        self.undo_stack.append(entry)
+        return bbox
+
+    def forget(self, surface):
+        # Drops what the history holds for a surface that is gone (e.g. a
+        # deleted layer), so no undo step ends up changing nothing
+        for stack in (self.undo_stack, self.redo_stack):
+            kept = deque()
+            for entry in stack:
+                gone = {key: tile for key, tile in entry.items() if key[0] is surface}
+                self.nbytes -= self.entry_bytes(gone)
+                if len(gone) < len(entry):
+                    kept.append({key: tile for key, tile in entry.items() if key[0] is not surface})
+            stack.clear()
+            stack.extend(kept)
+        if self.pending:
+            self.pending = {key: tile for key, tile in self.pending.items() if key[0] is not surface}
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.pending = None
+        self.nbytes = 0
+
+
+def load_font(size, path=None):
+    for name in ([path] if path else []) + ["arial.ttf", "DejaVuSans.ttf"]:
+        try:
+            return ImageFont.truetype(name, size)
+        except Exception:
+            pass
+    return ImageFont.load_default()
+
+
+def text_layout(x, y, text, font):
+    # Where text centred on (x, y) is drawn from, and the box it covers
+    bbox = _measure.textbbox((0, 0), text, font=font)
+    w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    pos = (x - w // 2, y - h // 2)
+    return pos, _measure.textbbox(pos, text, font=font)
+
+
+def shifted(points, origin):
+    return [(x - origin[0], y - origin[1]) for x, y in points]
+
+
+# Used to measure text without a target image
+_measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+
+
+class Selection:
+    # A selected region: its bounding box, plus a bitmask covering only that
+    # box for irregular shapes (None for a plain rectangle), so memory and
+    # every clipped operation scale with the selection, not the canvas.
+    def __init__(self, bbox, mask=None):
+        self.bbox = bbox
+        self.mask = mask if mask is None or mask.mode == "1" else mask.point(lambda v: 255 if v else 0, "1")
+
+    def contains(self, x, y):
+        x0, y0, x1, y1 = self.bbox
+        if not (x0 <= x < x1 and y0 <= y < y1):
+            return False
+        return self.mask is None or bool(self.mask.getpixel((x - x0, y - y0)))
+
+    def mask_for(self, bbox):
+        # The mask over bbox, which must lie inside the selection's bbox;
+        # None when all of it is selected
+        if self.mask is None:
+            return None
+        x0, y0 = self.bbox[:2]
+        return self.mask.crop((bbox[0] - x0, bbox[1] - y0, bbox[2] - x0, bbox[3] - y0))
+
+    def selected(self, bbox):
+        # "L" mask over any bbox: 255 where selected, 0 elsewhere
+        region = Image.new("L", (bbox[2] - bbox[0], bbox[3] - bbox[1]), 0)
+        inside = intersect_bbox(bbox, self.bbox)
+        if inside is not None:
+            mask = self.mask_for(inside)
+            region.paste(255, (inside[0] - bbox[0], inside[1] - bbox[1], inside[2] - bbox[0], inside[3] - bbox[1]),
+                         mask)
+        return region
+
+    def edges(self, bbox):
+        # "L" mask of the selected pixels in bbox that border unselected
+        # ones, for drawing the outline
+        x0, y0, x1, y1 = bbox
+        mask = self.selected((x0 - 1, y0 - 1, x1 + 1, y1 + 1))
+        inner = mask.filter(ImageFilter.MinFilter(3))
+        return ImageChops.subtract(mask, inner).crop((1, 1, x1 - x0 + 1, y1 - y0 + 1))
+
+
+class Document:
+    # A stack of tiled RGBA layers plus its undo history. Every operation is
+    # a plain call that returns the bounding box it changed, or None if
+    # nothing changed. Drawing operations work on the active layer: they
+    # copy out just the region they touch, draw on it and write it back, so
+    # their cost follows the stroke, not the canvas or the layer count.
+    # While there is a selection they are clipped to it, so both the work
+    # and what the history keeps are bounded by the selected region.
+    # Changes accumulate into one history entry until commit().
+    def __init__(self, width=800, height=600, background="white", undo_budget=128 * 1024 * 1024):
+        self.history = TileHistory(budget=undo_budget)
+        self.new(width, height, background)
+
+    @property
+    def width(self):
+        return self.composite.width
+
+    @property
+    def height(self):
+        return self.composite.height
+
+    @property
+    def layers(self):
+        return self.composite.layers
+
+    @property
+    def active(self):
+        return self.composite.active
+
+    @property
+    def surface(self):
+        return self.layers[self.active].surface
+
+    def new(self, width, height, background="white"):
+        self.restore(Composite([Layer(TiledImage(width, height, background), "Background")]))
+
+    def load(self, image, background="white"):
+        # image may also be a TiledImage already cut on another thread
+        if not isinstance(image, TiledImage):
+            image = TiledImage.from_image(image, background)
+        self.restore(Composite([Layer(image, "Background")]))
+
+    def restore(self, composite):
+        # Takes over a layer stack, e.g. a snapshot or a recovered session
+        self.composite = Composite([layer.snapshot() for layer in composite.layers], composite.active)
+        self.pyramid = Pyramid(self.composite)
+        self.history.clear()
+        self.selection = None
+
+    def restack(self):
+        # After any change to the stack itself, every cache is stale
+        self.composite.invalidate()
+        self.pyramid = Pyramid(self.composite)
+        return (0, 0, self.width, self.height)
+
+    def add_layer(self, name=None):
+        # A transparent layer above the active one, which becomes active
+        surface = TiledImage(self.width, self.height, (0, 0, 0, 0))
+        self.layers.insert(self.active + 1, Layer(surface, name or f"Layer {len(self.layers)}"))
+        self.composite.active += 1
+        return self.restack()
+
+    def delete_layer(self, index):
+        if len(self.layers) < 2:
+            return None
+        self.history.forget(self.layers.pop(index).surface)
+        self.composite.active = min(self.active, len(self.layers) - 1)
+        return self.restack()
+
+    def move_layer(self, index, offset):
+        target = index + offset
+        if not (0 <= target < len(self.layers)) or target == index:
+            return None
+        layer = self.layers.pop(index)
+        self.layers.insert(target, layer)
+        if self.active == index:
+            self.composite.active = target
+        return self.restack()
+
+    def select_layer(self, index):
+        if index == self.active or not (0 <= index < len(self.layers)):
+            return None
+        # The picture is unchanged, only the split between the caches moves
+        self.composite.active = index
+        self.composite.invalidate()
+        return None
+
+    def set_layer(self, index, opacity=None, visible=None, name=None):
+        layer = self.layers[index]
+        if name is not None:
+            layer.name = name
+        if (opacity is None or opacity == layer.opacity) and (visible is None or visible == layer.visible):
+            return None
+        if opacity is not None:
+            layer.opacity = opacity
+        if visible is not None:
+            layer.visible = visible
+        if index == self.active:
+            self.pyramid = Pyramid(self.composite)
+            return (0, 0, self.width, self.height)
+        return self.restack()
+
+    def crop(self, bbox):
+        return self.composite.crop(bbox)
+
+    def reduced(self, level, bbox):
+        # A region at 1/2**level scale, bbox given in that level's pixels
+        return self.pyramid.crop(level, bbox)
+
+    def to_image(self):
+        return self.composite.to_image()
+
+    def snapshot(self):
+        return self.composite.snapshot()
+
+    def select_rect(self, bbox):
+        # Returns the bbox of the old and new selection, to redraw
+        old = self.selection.bbox if self.selection else None
+        bbox = clip_bbox(bbox, self.width, self.height)
+        self.selection = Selection(bbox) if bbox else None
+        return union_bbox(old, bbox)
+
+    def select_wand(self, x, y, tolerance=0, connectivity=4, limit=None):
+        # Selects the region a fill from (x, y) would cover
+        old = self.selection.bbox if self.selection else None
+        self.selection = None
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return old
+        limit = clip_bbox(limit or (0, 0, self.width, self.height), self.width, self.height)
+        if limit is None or not (limit[0] <= x < limit[2] and limit[1] <= y < limit[3]):
+            return old
+        area = self.surface.crop(limit)
+        mask, bbox = flood_fill_mask(area, x - limit[0], y - limit[1], tolerance, connectivity)
+        bbox = (bbox[0] + limit[0], bbox[1] + limit[1], bbox[2] + limit[0], bbox[3] + limit[1])
+        self.selection = Selection(bbox, mask)
+        return union_bbox(old, bbox)
+
+    def select_mask(self, bbox, mask):
+        # Restores a selection exactly, e.g. a wand selection whose pixels
+        # have changed since it was made
+        old = self.selection.bbox if self.selection else None
+        self.selection = Selection(tuple(bbox), mask)
+        return union_bbox(old, self.selection.bbox)
+
+    def select_none(self):
+        old = self.selection.bbox if self.selection else None
+        self.selection = None
+        return old
+
+    def begin_change(self, bbox):
+        self.history.touch(self.surface, bbox)
+
+    def edit(self, bbox, masked=True):
+        # Returns a copy of the pixels under bbox to draw on, and the clipped
+        # bbox; hand both to apply() afterwards. None if bbox is off-canvas,
+        # or off the selection unless masked is False.
+        bbox = clip_bbox(bbox, self.width, self.height)
+        if bbox is not None and masked and self.selection is not None:
+            bbox = intersect_bbox(bbox, self.selection.bbox)
+        if bbox is None:
+            return None, None
+        self.begin_change(bbox)
+        return self.surface.crop(bbox), bbox
+
+    def apply(self, region, bbox, masked=True):
+        # Only selected pixels change, unless masked is False
+        mask = self.selection.mask_for(bbox) if masked and self.selection is not None else None
+        if mask is not None:
+            base = self.surface.crop(bbox)
+            base.paste(region, (0, 0), mask)
+            region = base
+        self.surface.paste(region, bbox[:2])
+        self.pyramid.invalidate(bbox)
+        return bbox
+
+    def commit(self):
+        return self.history.commit()
+
+    def undo(self):
+        return self.restored(self.history.undo())
+
+    def redo(self):
+        return self.restored(self.history.redo())
+
+    def restored(self, bbox):
+        # Undo can reach layers other than the active one
+        if bbox is not None:
+            self.composite.invalidate(bbox)
+            self.pyramid.invalidate(bbox)
+        return bbox
+
+    def stroke(self, points, color, width):
+        if len(points) == 1:
+            points = points * 2
+        region, bbox = self.edit(points_bbox(points, width // 2 + 1))
+        if region is None:
+            return None
+        ImageDraw.Draw(region).line(shifted(points, bbox), fill=color, width=width, joint="curve")
+        return self.apply(region, bbox)
+
+    def paint(self, brush, points):
+        # Dabs the brush along points; each dab is one masked blit of the
+        # cached tip into a region copied out once for the whole call
+        dabs, brush.residual = dab_positions(points, brush.step, brush.residual)
+        if not dabs:
+            return None
+        mask = dab_mask(brush.size, round(brush.hardness, 2))
+        c = mask.width // 2
+        dabs = [(round(x) - c, round(y) - c) for x, y in dabs]
+        region, bbox = self.edit(points_bbox([(x + c, y + c) for x, y in dabs], c + 1))
+        if region is None:
+            return None
+        if brush.erase:
+            # Fade alpha towards 0 under the mask
+            target = region.getchannel("A")
+            fill = 0
+        else:
+            target = region
+            fill = ImageColor.getrgb(brush.color)[:3] + (255,)
+        for x, y in dabs:
+            x -= bbox[0]
+            y -= bbox[1]
+            target.paste(fill, (x, y, x + mask.width, y + mask.height), mask)
+        if brush.erase:
+            region.putalpha(target)
+        return self.apply(region, bbox)
+
+    def shape(self, kind, x1, y1, x2, y2, color, width):
+        region, bbox = self.edit(points_bbox([(x1, y1), (x2, y2)], width))
+        if region is None:
+            return None
+        draw = ImageDraw.Draw(region)
+        (x1, y1), (x2, y2) = shifted([(x1, y1), (x2, y2)], bbox)
+        if kind == "line":
+            draw.line([(x1, y1), (x2, y2)], fill=color, width=width)
+        elif kind == "square":
+            draw.rectangle([min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)], outline=color, width=width)
+        elif kind == "circle":
+            draw.ellipse([min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)], outline=color, width=width)
+        return self.apply(region, bbox)
+
+    def spray(self, x, y, color, radius, rng, density=10, falloff=1.0):
+        points = spray_points(rng, x, y, radius, density, falloff, self.width, self.height)
+        region, bbox = self.edit((x - radius, y - radius, x + radius + 1, y + radius + 1))
+        if region is None:
+            return None
+        if len(points):
+            points = points - (bbox[0], bbox[1])
+            ImageDraw.Draw(region).point(points.ravel().tolist(), fill=color)
+        return self.apply(region, bbox)
+
+    def erase(self, x, y, radius):
+        # Clears the active layer to transparent
+        region, bbox = self.edit((x - radius, y - radius, x + radius + 1, y + radius + 1))
+        if region is None:
+            return None
+        x0, y0 = x - radius - bbox[0], y - radius - bbox[1]
+        ImageDraw.Draw(region).ellipse([x0, y0, x0 + 2 * radius, y0 + 2 * radius], fill=(0, 0, 0, 0))
+        return self.apply(region, bbox)
+
+    def fill(self, x, y, color, tolerance=0, connectivity=4, limit=None):
+        # limit bounds the area the fill may spread over (default: the whole
+        # canvas); on very large canvases callers pass the visible region
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        limit = clip_bbox(limit or (0, 0, self.width, self.height), self.width, self.height)
+        within = None
+        if self.selection is not None and limit is not None:
+            # The fill spreads through selected pixels only
+            if not self.selection.contains(x, y):
+                return None
+            limit = intersect_bbox(limit, self.selection.bbox)
+            if self.selection.mask is not None:
+                within = self.selection.mask_for(limit)
+        if limit is None or not (limit[0] <= x < limit[2] and limit[1] <= y < limit[3]):
+            return None
+        area = self.surface.crop(limit)
+        target_color = area.getpixel((x - limit[0], y - limit[1]))
+        fill_color = ImageColor.getrgb(color)[:3] + (255,)
+        if target_color == fill_color and not tolerance:
+            return None  # no need to fill if same color
+
+        mask, bbox = flood_fill_mask(area, x - limit[0], y - limit[1], tolerance, connectivity, within)
+        bbox = (bbox[0] + limit[0], bbox[1] + limit[1], bbox[2] + limit[0], bbox[3] + limit[1])
+        self.begin_change(bbox)
+        region = area.crop((bbox[0] - limit[0], bbox[1] - limit[1], bbox[2] - limit[0], bbox[3] - limit[1]))
+        region.paste(fill_color, (0, 0) + region.size, mask)
+        # The fill mask already stays inside the selection
+        return self.apply(region, bbox, masked=False)
+
+    def text(self, x, y, text, font, color):
+        # Centred on (x, y)
+        pos, bbox = text_layout(x, y, text, font)
+        region, bbox = self.edit(bbox)
+        if region is None:
+            return None
+        ImageDraw.Draw(region).text(shifted([pos], bbox)[0], text, fill=color, font=font)
+        return self.apply(region, bbox)
+
+    def stamp(self, stamp, x, y, mask=None):
+        # Centred on (x, y), blended through mask (default: the stamp's own
+        # alpha)
+        w, h = stamp.size
+        pos = (x - w // 2, y - h // 2)
+        region, bbox = self.edit((pos[0], pos[1], pos[0] + w, pos[1] + h))
+        if region is None:
+            return None
+        region.paste(stamp, shifted([pos], bbox)[0], mask or stamp)
+        return self.apply(region, bbox)
+
+    def patch(self, image, xy, masked=False):
+        # Overwrites a region with image, e.g. when replaying a journal.
+        # Ignores the selection unless masked is True.
+        region, bbox = self.edit((xy[0], xy[1], xy[0] + image.width, xy[1] + image.height), masked)
+        if region is None:
+            return None
+        region.paste(image, (xy[0] - bbox[0], xy[1] - bbox[1]))
+        return self.apply(region, bbox, masked)
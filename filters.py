@@ -0,0 +1,194 @@
+# Image filters run across a process pool. The source pixels are copied
+# once into a shared memory block and the workers write into a second one,
+# so no pixels are pickled. The region is cut into tiles that overlap by
+# each filter's reach (its halo), so the stitched result matches running
+# the filter over the whole region at once.
+from PIL import Image, ImageFilter, ImageOps
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import math
+import os
+import queue
+import threading
+
+
+def gaussian_blur(image, radius=2.0):
+    return image.filter(ImageFilter.GaussianBlur(radius))
+
+
+def sharpen(image, radius=2.0, percent=150, threshold=3):
+    return image.filter(ImageFilter.UnsharpMask(radius, percent, threshold))
+
+
+def brightness_contrast(image, brightness=0, contrast=0):
+    # Brightness in -100..100, contrast in -99..99 (100 would be a pure
+    # threshold). Contrast pivots on mid-grey rather than the image mean,
+    # so each tile can be done on its own.
+    gain = math.tan((contrast + 100) / 200 * math.pi / 2)
+    lut = [max(0, min(255, round((v - 128) * gain + 128 + brightness * 2.55))) for v in range(256)]
+    return image.point(lut * 3 + list(range(256)))
+
+
+def invert(image):
+    rgb = ImageOps.invert(image.convert("RGB"))
+    rgb.putalpha(image.getchannel("A"))
+    return rgb
+
+
+def posterize(image, bits=3):
+    rgb = ImageOps.posterize(image.convert("RGB"), bits)
+    rgb.putalpha(image.getchannel("A"))
+    return rgb
+
+
+FILTERS = {
+    "blur": gaussian_blur,
+    "sharpen": sharpen,
+    "brightness_contrast": brightness_contrast,
+    "invert": invert,
+    "posterize": posterize,
+}
+
+
+def halo(name, params):
+    # How far a filter reads beyond the pixel it writes
+    if name == "blur":
+        return math.ceil(params.get("radius", 2.0) * 6) + 2
+    if name == "sharpen":
+        return math.ceil(params.get("radius", 2.0) * 6) + 2
+    return 0
+
+
+def attach(name):
+    # The runner owns and unlinks the blocks. Where attaching can't opt out
+    # of tracking (before Python 3.13) the worker registers them with the
+    # runner's own resource tracker (see FilterRunner.start), which already
+    # holds them, so there is nothing for a worker to undo.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def filter_tile(source, target, size, rect, margin, name, params):
+    # Runs in a worker: filters rect of the shared source image (plus a
+    # margin of context) and writes it into the shared target image
+    import numpy as np
+    width, height = size
+    x0, y0, x1, y1 = rect
+    hx0, hy0 = max(0, x0 - margin), max(0, y0 - margin)
+    hx1, hy1 = min(width, x1 + margin), min(height, y1 + margin)
+    src, dst = attach(source), attach(target)
+    try:
+        pixels = np.ndarray((height, width, 4), np.uint8, src.buf)
+        tile = FILTERS[name](Image.fromarray(pixels[hy0:hy1, hx0:hx1], "RGBA"), **params)
+        out = np.ndarray((height, width, 4), np.uint8, dst.buf)
+        out[y0:y1, x0:x1] = np.asarray(tile.convert("RGBA"))[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+        del pixels, out
+    finally:
+        src.close()
+        dst.close()
+    return rect
+
+
+class FilterRunner:
+    # Runs one filter at a time on a background thread that feeds the
+    # process pool; the UI polls for progress and the result.
+    def __init__(self, workers=None, tile_size=512):
+        self.workers = workers
+        self.tile_size = tile_size
+        self.pool = None
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.results = queue.Queue()
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, image, name, params):
+        # image is an RGBA Image, or anything with to_image() (e.g. a tiled
+        # snapshot), flattened on the background thread
+        if self.pool is None:
+            if os.name == "posix":
+                # Workers forked after this share the tracker instead of
+                # starting their own, which would unlink the blocks when a
+                # worker exits. Spawned workers are handed it anyway;
+                # Windows has no tracker.
+                resource_tracker.ensure_running()
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            # Start the workers from this thread rather than the feeder
+            self.pool.submit(int)
+        self.cancelled.clear()
+        self.thread = threading.Thread(target=self.run, args=(image, name, params), daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def poll(self):
+        # ("progress", done, total), then ("done", image), ("cancelled",) or
+        # ("error", exception)
+        done = []
+        while True:
+            try:
+                done.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return done
+
+    def run(self, image, name, params):
+        import numpy as np
+        source = target = None
+        futures = []
+        try:
+            if hasattr(image, "to_image"):
+                image = image.to_image()
+            width, height = image.size
+            nbytes = width * height * 4
+            source = shared_memory.SharedMemory(create=True, size=nbytes)
+            target = shared_memory.SharedMemory(create=True, size=nbytes)
+            np.ndarray((height, width, 4), np.uint8, source.buf)[:] = np.asarray(
+                image if image.mode == "RGBA" else image.convert("RGBA"))
+            del image
+            ts = self.tile_size
+            rects = [(x, y, min(x + ts, width), min(y + ts, height))
+                     for y in range(0, height, ts) for x in range(0, width, ts)]
+            margin = halo(name, params)
+            futures = [self.pool.submit(filter_tile, source.name, target.name, (width, height),
+                                        rect, margin, name, params) for rect in rects]
+            for done, future in enumerate(futures, 1):
+                while not future.done():
+                    if self.cancelled.wait(0.05):
+                        break
+                if self.cancelled.is_set():
+                    self.results.put(("cancelled",))
+                    return
+                future.result()
+                self.results.put(("progress", done, len(rects)))
+            pixels = np.ndarray((height, width, 4), np.uint8, target.buf)
+            self.results.put(("done", Image.fromarray(pixels.copy(), "RGBA")))
+            del pixels
+        except Exception as e:
+            self.results.put(("error", e))
+        finally:
+            for future in futures:
+                future.cancel()
+            # Tiles already running must finish before the memory goes
+            for future in futures:
+                if not future.cancelled():
+                    try:
+                        future.result()
+                    except Exception:
+                        pass
+            for shm in (source, target):
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+
+    def close(self):
+        self.cancel()
+        if self.thread is not None:
+            self.thread.join()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,110 @@
+# Font faces for the text tool. The system font directories are scanned
+# once and the face -> file index is kept in cache/, checked against the
+# directories' mtimes so an unchanged system is never rescanned. Loaded
+# (face, size) fonts are kept in an LRU, so neither text placement nor the
+# live preview re-reads a font file.
+from PIL import ImageFont
+from collections import OrderedDict
+import json
+import os
+import sys
+
+from engine import load_font
+
+
+def font_dirs():
+    home = os.path.expanduser("~")
+    if sys.platform.startswith("win"):
+        return [os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts"),
+                os.path.join(os.environ.get("LOCALAPPDATA", home), "Microsoft", "Windows", "Fonts")]
+    if sys.platform == "darwin":
+        return ["/System/Library/Fonts", "/Library/Fonts", os.path.join(home, "Library", "Fonts")]
+    return ["/usr/share/fonts", "/usr/local/share/fonts",
+            os.path.join(home, ".fonts"), os.path.join(home, ".local", "share", "fonts")]
+
+
+class FontRegistry:
+    preferred = ("Arial Regular", "DejaVu Sans Book", "Liberation Sans Regular")
+
+    def __init__(self, directory="cache", capacity=16, dirs=None):
+        self.index_path = os.path.join(directory, "font_index.json")
+        self.dirs = dirs if dirs is not None else font_dirs()
+        self.capacity = capacity
+        self.fonts = OrderedDict()
+        self.faces = None
+        self.scanned = None
+
+    def load_index(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if index.get("roots") != self.dirs:
+            return False
+        for path, mtime in index.get("dirs", {}).items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        self.faces, self.scanned = index["faces"], index["dirs"]
+        return True
+
+    def scan(self):
+        # Walks every font directory; slow, so only done when the index is
+        # missing or a directory changed
+        self.faces, self.scanned = {}, {}
+        for root in self.dirs:
+            for path, _, files in os.walk(root):
+                try:
+                    self.scanned[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                for file in sorted(files):
+                    if not file.lower().endswith((".ttf", ".otf", ".ttc")):
+                        continue
+                    file = os.path.join(path, file)
+                    try:
+                        family, style = ImageFont.truetype(file, 12).getname()
+                    except Exception:
+                        continue
+                    name = f"{family} {style}" if style else family
+                    self.faces.setdefault(name, file)
+        tmp = self.index_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"roots": self.dirs, "dirs": self.scanned, "faces": self.faces}, f)
+            os.replace(tmp, self.index_path)
+        except OSError:
+            pass
+
+    def names(self):
+        if self.faces is None and not self.load_index():
+            self.scan()
+        return sorted(self.faces)
+
+    def default_face(self):
+        names = self.names()
+        for name in self.preferred:
+            if name in self.faces:
+                return name
+        regular = [name for name in names if name.endswith((" Regular", " Book"))]
+        return (regular or names or [None])[0]
+
+    def font(self, face, size):
+        key = (face, size)
+        font = self.fonts.get(key)
+        if font is not None:
+            self.fonts.move_to_end(key)
+            return font
+        path = None
+        if face:
+            if self.faces is None:
+                self.names()
+            path = self.faces.get(face)
+        font = load_font(size, path)
+        self.fonts[key] = font
+        while len(self.fonts) > self.capacity:
+            self.fonts.popitem(last=False)
+        return font
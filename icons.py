@@ -0,0 +1,69 @@
+# GUI icons packed side by side into one sprite atlas in cache/, so startup
+# decodes a single PNG rather than opening and resizing every file in gui/.
+# The atlas is rebuilt when an icon file is added, removed or changed
+# (checked by mtime, which needs no decoding) or the icon size changes.
+from PIL import Image
+import json
+import os
+
+
+class IconAtlas:
+    def __init__(self, directory="cache", gui_dir="gui", size=(32, 32)):
+        self.image_path = os.path.join(directory, "gui_atlas.png")
+        self.index_path = os.path.join(directory, "gui_atlas.json")
+        self.gui_dir = gui_dir
+        self.size = size
+
+    def sources(self, files):
+        # name -> [file, mtime] for the icon files that exist
+        found = {}
+        for name, file in files.items():
+            try:
+                found[name] = [file, os.stat(os.path.join(self.gui_dir, file)).st_mtime_ns]
+            except OSError:
+                pass
+        return found
+
+    def load(self, files):
+        # files maps icon names to files in gui_dir. Returns the atlas image
+        # (None if there are no icons) and name -> box within it; names
+        # whose file is missing or unreadable have no box.
+        sources = self.sources(files)
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            if index["size"] == list(self.size) and index["sources"] == sources:
+                atlas = Image.open(self.image_path)
+                atlas.load()
+                return atlas, {name: tuple(box) for name, box in index["boxes"].items()}
+        except (OSError, ValueError, KeyError):
+            pass
+        return self.build(sources)
+
+    def build(self, sources):
+        w, h = self.size
+        icons = {}
+        for name, (file, _) in sources.items():
+            try:
+                icons[name] = Image.open(os.path.join(self.gui_dir, file)).convert("RGBA").resize(self.size)
+            except Exception:
+                pass
+        if not icons:
+            return None, {}
+        atlas = Image.new("RGBA", (w * len(icons), h), (0, 0, 0, 0))
+        boxes = {}
+        for i, (name, icon) in enumerate(icons.items()):
+            atlas.paste(icon, (i * w, 0))
+            boxes[name] = (i * w, 0, (i + 1) * w, h)
+        try:
+            # Image first: the index is only trusted if it matches the files
+            tmp = self.image_path + ".tmp"
+            atlas.save(tmp, "PNG")
+            os.replace(tmp, self.image_path)
+            tmp = self.index_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"size": list(self.size), "sources": sources, "boxes": boxes}, f)
+            os.replace(tmp, self.index_path)
+        except OSError:
+            pass
+        return atlas, boxes
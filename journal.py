@@ -0,0 +1,311 @@
+# Append-only journal of drawing operations, kept in cache/ so unsaved work
+# can be rebuilt after a crash. Each generation is a checkpoint plus a
+# JSON-lines file of the operations drawn on top of it; all file writes
+# happen on a worker thread. A checkpoint is a project file (see
+# project.py), so tiles still compressed in an opened project are copied
+# over as they are.
+#
+# Every running window journals into a session directory of its own under
+# cache/sessions/ and holds a lock on a file in it until it exits. The OS
+# drops the lock when a process dies, so a session whose lock can be taken
+# was left by a crash; only those are offered for recovery, and a window
+# only ever deletes its own session and the one it recovered.
+from PIL import Image
+import base64
+import io
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+from engine import Brush, Composite, Layer, TiledImage, load_font
+from project import EXTENSION, Project
+
+
+LOCK = "session.lock"
+# A session that never got as far as a checkpoint is only cleared away
+# once it is this old, so a window still starting up keeps its directory
+EMPTY_SESSION_AGE = 60
+
+
+def lock(path):
+    # Returns the open lock file, or None if another process holds it
+    f = open(path, "a")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class Journal:
+    def __init__(self, directory="cache", checkpoint_every=100):
+        self.sessions = os.path.join(directory, "sessions")
+        os.makedirs(self.sessions, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix="session-", dir=self.sessions)
+        self.lock = lock(os.path.join(self.directory, LOCK))
+        self.orphan = None  # (directory, lock) of the crashed session on offer
+        self.checkpoint_every = checkpoint_every
+        self.generation = 0
+        self.since_checkpoint = 0
+        self.queue = queue.Queue()
+        self.thread = None
+        self.file = None
+
+    def path(self, kind, generation, directory=None):
+        ext = EXTENSION if kind == "checkpoint" else ".jsonl"
+        return os.path.join(directory or self.directory, f"{kind}-{generation}{ext}")
+
+    def generations(self, directory=None):
+        found = []
+        for file in os.listdir(directory or self.directory):
+            name, ext = os.path.splitext(file)
+            if name.startswith("checkpoint-") and ext == EXTENSION:
+                try:
+                    found.append(int(name[len("checkpoint-"):]))
+                except ValueError:
+                    pass
+        return sorted(found)
+
+    def has_recovery(self):
+        # Looks for sessions left by a crash and keeps the newest on offer
+        # (locked, so no other window takes it too); the rest wait for
+        # the next start
+        if self.orphan is not None:
+            return True
+        found = []
+        for name in os.listdir(self.sessions):
+            directory = os.path.join(self.sessions, name)
+            if directory == self.directory or not os.path.isdir(directory):
+                continue
+            try:
+                generations = self.generations(directory)
+                if not generations:
+                    if time.time() - os.path.getmtime(directory) > EMPTY_SESSION_AGE:
+                        held = lock(os.path.join(directory, LOCK))
+                        if held is not None:
+                            held.close()
+                            shutil.rmtree(directory, ignore_errors=True)
+                    continue
+                mtime = os.path.getmtime(self.path("checkpoint", generations[-1], directory))
+            except OSError:
+                continue  # gone meanwhile
+            found.append((mtime, directory))
+        for _, directory in sorted(found, reverse=True):
+            try:
+                held = lock(os.path.join(directory, LOCK))
+            except OSError:
+                continue
+            if held is not None:
+                self.orphan = (directory, held)
+                return True
+        return False
+
+    def recover(self):
+        # Returns the newest complete checkpoint of the crashed session, as
+        # a Composite of its layers, and the operations recorded after it;
+        # a torn last line from the crash is skipped. The session is
+        # deleted once this one's first checkpoint is written.
+        directory = self.orphan[0]
+        generation = self.generations(directory)[-1]
+        # Read in full, so the checkpoint can be deleted once superseded
+        _, composite = Project.open(self.path("checkpoint", generation, directory), lazy=False)
+        records = []
+        try:
+            with open(self.path("journal", generation, directory), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        return composite, records
+
+    def discard_recovery(self):
+        # Deletes the crashed session on offer
+        if self.orphan is not None:
+            directory, held = self.orphan
+            self.orphan = None
+            held.close()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def start(self, image, selection=None):
+        # Begins a new generation from a snapshot of the document (an Image
+        # or a Composite snapshot, written out on the worker thread). A
+        # checkpoint only holds pixels, so the selection that clips what is
+        # recorded after it opens the new journal.
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.generation += 1
+        self.since_checkpoint = 0
+        self.queue.put(("checkpoint", self.generation, image))
+        if selection is not None:
+            if selection.mask is None:
+                record = {"op": "select", "kind": "rect", "coords": list(selection.bbox)}
+            else:
+                record = {"op": "select", "kind": "mask", "coords": list(selection.bbox), "image": selection.mask}
+            self.queue.put(("record", record))
+
+    def record(self, op, **args):
+        args["op"] = op
+        self.queue.put(("record", args))
+        self.since_checkpoint += 1
+
+    def needs_checkpoint(self):
+        return self.since_checkpoint >= self.checkpoint_every
+
+    def close(self, discard=True):
+        # discard=False leaves the session behind as if it had crashed
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.orphan is not None:
+            self.orphan[1].close()
+            self.orphan = None
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+        if discard:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # Write everything that queued up meanwhile in one go
+            batch = [item]
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+            stop = None in batch
+            self.write_batch([b for b in batch if b is not None])
+            if stop:
+                break
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write_batch(self, batch):
+        lines = []
+        for item in batch:
+            if item[0] == "record":
+                lines.append(self.encode(item[1]))
+                continue
+            self.write_lines(lines)
+            lines = []
+            self.write_checkpoint(item[1], item[2])
+        self.write_lines(lines)
+
+    def encode(self, record):
+        # Patches carry their pixels as an Image; they are PNG-encoded here
+        # rather than on the UI thread
+        image = record.pop("image", None)
+        if image is not None:
+            data = io.BytesIO()
+            image.save(data, "PNG", compress_level=1)
+            record["png"] = base64.b64encode(data.getvalue()).decode("ascii")
+        return json.dumps(record, separators=(",", ":"))
+
+    def write_lines(self, lines):
+        if lines and self.file is not None:
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+
+    def write_checkpoint(self, generation, image):
+        if not hasattr(image, "layers"):
+            image = Composite([Layer(TiledImage.from_image(image), "Background")])
+        Project(self.path("checkpoint", generation)).save(image, compress_level=1)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path("journal", generation), "w", encoding="utf-8")
+        for old in self.generations():
+            if old < generation:
+                self.remove_generation(old)
+        # A recovered session is safe to drop once its work is in here
+        if self.orphan is not None:
+            self.discard_recovery()
+
+    def remove_generation(self, generation):
+        for kind in ("checkpoint", "journal"):
+            try:
+                os.remove(self.path(kind, generation))
+            except FileNotFoundError:
+                pass
+
+
+def replay(doc, record, load_stamp, get_font=lambda face, size: load_font(size)):
+    # Applies one journal record to a Document. Undo and redo are journaled
+    # as patches of the pixels they restored, because the history they
+    # reached into may predate the checkpoint.
+    op = record["op"]
+    if op == "paint":
+        brush = Brush(record["size"], record.get("color", "black"), record["hardness"], record["spacing"],
+                      record.get("erase", False))
+        for segment in record["segments"]:
+            doc.paint(brush, [tuple(p) for p in segment])
+    elif op == "stroke":
+        for segment in record["segments"]:
+            doc.stroke([tuple(p) for p in segment], record["color"], record["width"])
+    elif op == "spray":
+        import numpy as np
+        rng = np.random.default_rng(record["seed"])
+        for x, y in record["points"]:
+            doc.spray(x, y, record["color"], record["radius"], rng, record["density"], record["falloff"])
+    elif op == "erase":
+        for x, y in record["points"]:
+            doc.erase(x, y, record["radius"])
+    elif op == "fill":
+        doc.fill(record["x"], record["y"], record["color"], record["tolerance"], record["connectivity"],
+                 record.get("limit"))
+    elif op == "shape":
+        doc.shape(record["kind"], *record["coords"], record["color"], record["width"])
+    elif op == "text":
+        font = get_font(record.get("face"), record["size"])
+        doc.text(record["x"], record["y"], record["text"], font, record["color"])
+    elif op == "stamp":
+        stamp = load_stamp(record["path"], record.get("size"))
+        if stamp is not None:
+            doc.stamp(stamp[0], record["x"], record["y"], stamp[1])
+    elif op == "patch":
+        patch = Image.open(io.BytesIO(base64.b64decode(record["png"]))).convert("RGBA")
+        active = doc.active
+        doc.select_layer(record.get("layer", active))
+        doc.patch(patch, (record["x"], record["y"]))
+        doc.select_layer(active)
+    elif op == "select":
+        if record["kind"] == "rect":
+            doc.select_rect(record["coords"])
+        elif record["kind"] == "wand":
+            doc.select_wand(record["x"], record["y"], record["tolerance"], record["connectivity"],
+                            record.get("limit"))
+        elif record["kind"] == "mask":
+            mask = Image.open(io.BytesIO(base64.b64decode(record["png"]))).convert("1")
+            doc.select_mask(record["coords"], mask)
+        else:
+            doc.select_none()
+    elif op == "layer_add":
+        doc.add_layer(record["name"])
+    elif op == "layer_delete":
+        doc.delete_layer(record["index"])
+    elif op == "layer_move":
+        doc.move_layer(record["index"], record["offset"])
+    elif op == "layer_select":
+        doc.select_layer(record["index"])
+    elif op == "layer_set":
+        doc.set_layer(record["index"], record.get("opacity"), record.get("visible"), record.get("name"))
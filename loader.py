@@ -0,0 +1,91 @@
+# Opens images on a worker thread so a big photo never blocks the UI. Each
+# open first reports a small preview (decoded at reduced scale where the
+# format allows it, e.g. JPEG's DCT scaling) that can stand in while the
+# full image is decoded and cut into tiles.
+from PIL import Image, ImageOps
+import queue
+import threading
+import time
+
+from engine import TiledImage
+
+FORMATS = ("*.png", "*.jpg", "*.jpeg", "*.bmp", "*.gif", "*.tif", "*.tiff", "*.webp", "*.ico", "*.tga")
+
+
+def fit(size, side):
+    # size scaled down so its longest side is at most side
+    if not side or max(size) <= side:
+        return size
+    scale = side / max(size)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+
+def load_image(path, max_side=None, preview_side=512):
+    # Yields ("preview", (image, full size)) once, then ("done", TiledImage).
+    # max_side limits the decoded size; draft() and reduce() get there
+    # without decoding the full resolution first where they can.
+    previewed = False
+    with Image.open(path) as image:
+        size = image.size
+        target = fit(size, max_side)
+        if image.format == "JPEG":
+            # EXIF orientations 5-8 are rotated by 90 degrees
+            final = target[::-1] if image.getexif().get(0x0112, 1) in (5, 6, 7, 8) else target
+            with Image.open(path) as preview:
+                preview.draft("RGB", fit(size, preview_side))
+                preview = ImageOps.exif_transpose(preview)
+                preview.thumbnail((preview_side, preview_side), reducing_gap=2.0)
+                yield "preview", (preview.convert("RGBA"), final)
+            previewed = True
+        if target != size:
+            image.draft("RGB", target)
+            image.thumbnail(target, Image.LANCZOS, reducing_gap=2.0)
+        else:
+            image.load()
+        # In place: a copy of a full-size image is what this is meant to avoid
+        ImageOps.exif_transpose(image, in_place=True)
+        if not previewed:
+            preview = image.resize(fit(image.size, preview_side), reducing_gap=2.0)
+            yield "preview", (preview.convert("RGBA"), image.size)
+        yield "done", TiledImage.from_image(image)
+
+
+class Loader:
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = None
+        self.current = 0
+
+    def open(self, path, max_side=None, preview_side=512):
+        # Returns a ticket; results for older tickets are stale
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.current += 1
+        self.jobs.put((self.current, path, max_side, preview_side))
+        return self.current
+
+    def poll(self):
+        # (ticket, kind, path, payload, seconds) for each result since the
+        # last poll; kind is "preview", "done" or "error", and seconds is how
+        # long the worker had been decoding when it got there
+        done = []
+        while True:
+            try:
+                done.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return done
+
+    def run(self):
+        while True:
+            ticket, path, max_side, preview_side = self.jobs.get()
+            start = time.perf_counter()
+            try:
+                for kind, payload in load_image(path, max_side, preview_side):
+                    if ticket != self.current:
+                        break  # superseded by a newer open
+                    self.results.put((ticket, kind, path, payload, time.perf_counter() - start))
+            except Exception as e:
+                self.results.put((ticket, "error", path, e, time.perf_counter() - start))
@@ -0,0 +1,248 @@
+# Craftsman project files (.craft): every layer's tiles, each compressed on
+# its own, followed by a JSON index of the layers and where their tiles are.
+#
+#   header  magic, index offset, index length
+#   blobs   zlib-compressed RGBA tiles, in any order
+#   index   {"width", "height", "tile_size", "active", "layers": [...]}
+#
+# Saving again only appends the tiles that changed since the last save and
+# a new index, then points the header at it, so the file is never in a
+# half-written state. Unchanged tiles are recognised by identity: drawing
+# never writes into a tile that a snapshot shares, so a tile object that was
+# saved still holds the saved pixels. Once replaced tiles and old indexes
+# outweigh the live ones the file is rewritten compactly.
+#
+# Opening memory-maps the file and leaves every tile compressed; a tile is
+# only decoded when something first reads its pixels.
+from PIL import Image
+import json
+import mmap
+import os
+import struct
+import threading
+import weakref
+import zlib
+
+from engine import Composite, Layer, TiledImage
+
+MAGIC = b"CRAFT\x00\x01\n"
+HEADER = struct.Struct("<8sQQ")
+EXTENSION = ".craft"
+# Rewrite the whole file once this share of it is dead
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 4 * 1024 * 1024
+
+
+class StoredTile:
+    # A tile still compressed in a project file; TiledImage decodes it the
+    # first time its pixels are read
+    def __init__(self, store, offset, length, width, height):
+        self.store = store
+        self.offset, self.length = offset, length
+        self.width, self.height = width, height
+        self.data = None  # the compressed bytes, once the file can't hold them
+
+    def raw(self):
+        if self.data is not None:
+            return self.data
+        return self.store.read(self)
+
+    def decode(self):
+        image = Image.frombytes("RGBA", (self.width, self.height), zlib.decompress(self.raw()))
+        if self.data is None:
+            # The decoded pixels are the saved ones until something draws on them
+            self.store.remember(image, self.offset, self.length)
+        return image
+
+
+class Project:
+    # One .craft file. Saves run on the saver thread while the UI thread
+    # decodes tiles, so the lock covers the mapping and the tile table.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.size = 0
+        self.saved = {}  # id(tile) -> (weakref, offset, length) for tiles in the file
+        self.stored = weakref.WeakSet()  # StoredTiles pointing into the file
+
+    @classmethod
+    def open(cls, path, lazy=True):
+        # Returns (project, Composite). With lazy=False every tile is decoded
+        # up front and the file is closed again.
+        project = cls(path)
+        with project.lock:
+            offset, length = project.attach()
+            info = json.loads(project.map[offset:offset + length])
+        layers = []
+        for settings in info["layers"]:
+            surface = TiledImage(info["width"], info["height"], tuple(settings["background"]), info["tile_size"])
+            for tx, ty, offset, length in settings["tiles"]:
+                box = surface.tile_box((tx, ty))
+                tile = StoredTile(project, offset, length, box[2] - box[0], box[3] - box[1])
+                project.stored.add(tile)
+                surface.tiles[tx, ty] = tile if lazy else tile.decode()
+            layers.append(Layer(surface, settings["name"], settings["opacity"], settings["visible"]))
+        if not lazy:
+            project.close()
+        return project, Composite(layers, info["active"])
+
+    def attach(self):
+        # Opens the file for appending and maps all of it for reading;
+        # returns where the index is. Called with the lock held.
+        self.file = open(self.path, "r+b")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, offset, length = HEADER.unpack_from(self.map, 0)
+        except (ValueError, struct.error):
+            magic = None
+        if magic != MAGIC:
+            self.detach()
+            raise ValueError(f"{os.path.basename(self.path)} is not a Craftsman project")
+        self.size = len(self.map)
+        return offset, length
+
+    def detach(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        with self.lock:
+            self.detach()
+
+    def read(self, tile):
+        with self.lock:
+            if self.map is None:
+                self.attach()
+            return self.map[tile.offset:tile.offset + tile.length]
+
+    def remember(self, tile, offset, length):
+        with self.lock:
+            self.saved[id(tile)] = (weakref.ref(tile), offset, length)
+
+    def find(self, tile):
+        # (offset, length) of tile if this file already holds it
+        if isinstance(tile, StoredTile) and tile.store is self and tile.data is None:
+            return tile.offset, tile.length
+        entry = self.saved.get(id(tile))
+        if entry is not None and entry[0]() is tile:
+            return entry[1:]
+        return None
+
+    def save(self, composite, compress_level=1):
+        # composite should be a snapshot, so drawing can go on meanwhile.
+        # Only tiles the file doesn't hold yet are compressed and written.
+        with self.lock:
+            self.saved = {key: entry for key, entry in self.saved.items() if entry[0]() is not None}
+            # Only a file this project wrote or opened is appended to; any
+            # other file at the path (e.g. Save As over another project) is
+            # replaced, so none of its tiles linger as dead bytes
+            ours = self.saved or len(self.stored)
+            if self.file is None and ours and os.path.exists(self.path):
+                try:
+                    self.attach()
+                except ValueError:
+                    pass  # not a project (any more); replaced below
+            fresh = self.file is None
+        if fresh:
+            return self.rewrite(composite, compress_level)
+        self.file.seek(self.size)
+        info, live, _, written = self.write_tiles(self.file, self.size, composite, compress_level, False)
+        index_offset, index_length = self.write_index(self.file, info)
+        # Switching the header over is the moment the new save counts
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, index_offset, index_length))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        with self.lock:
+            self.saved.update(written)
+            self.detach()
+            self.attach()
+        dead = self.size - HEADER.size - live - index_length
+        if dead > COMPACT_MIN_BYTES and dead > COMPACT_RATIO * self.size:
+            self.rewrite(composite, compress_level)
+
+    def rewrite(self, composite, compress_level):
+        # Writes the whole file afresh under a temporary name and swaps it in.
+        # Compressed tiles are copied rather than compressed again.
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(HEADER.pack(MAGIC, 0, 0))
+                info, _, moved, written = self.write_tiles(f, HEADER.size, composite, compress_level, True)
+                index_offset, index_length = self.write_index(f, info)
+                f.seek(0)
+                f.write(HEADER.pack(MAGIC, index_offset, index_length))
+                f.flush()
+                os.fsync(f.fileno())
+            with self.lock:
+                # Tiles kept only by the undo history hold on to their bytes
+                for tile in list(self.stored):
+                    if tile.data is None and (tile.offset, tile.length) not in moved:
+                        tile.data = self.map[tile.offset:tile.offset + tile.length]
+                self.detach()
+                os.replace(tmp, self.path)
+                for tile in list(self.stored):
+                    if tile.data is None:
+                        tile.offset, tile.length = moved[tile.offset, tile.length]
+                self.saved = {key: (ref, *moved[offset, length])
+                              for key, (ref, offset, length) in self.saved.items()
+                              if ref() is not None and (offset, length) in moved}
+                self.saved.update(written)
+                self.attach()
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def write_tiles(self, f, position, composite, compress_level, rewrite):
+        # Writes the tiles out from position. Returns the index, the bytes
+        # its tiles take, {old span: new span} for tiles that moved and the
+        # table entries for tiles written for the first time. Unless
+        # rewriting, tiles already in the file stay put.
+        info = {"width": composite.width, "height": composite.height, "tile_size": composite.tile_size,
+                "active": composite.active, "layers": []}
+        live = 0
+        moved = {}
+        written = {}
+        for layer in composite.layers:
+            tiles = []
+            for (tx, ty), tile in layer.surface.tiles.items():
+                found = self.find(tile)
+                if id(tile) in written:
+                    offset, length = written[id(tile)][1:]
+                elif found is not None and found in moved:
+                    offset, length = moved[found]
+                elif found is not None and not rewrite:
+                    offset, length = found
+                else:
+                    if found is not None:
+                        blob = self.map[found[0]:found[0] + found[1]]
+                    elif isinstance(tile, StoredTile):
+                        blob = tile.raw()  # from another project; copied as is
+                    else:
+                        blob = zlib.compress(tile.tobytes(), compress_level)
+                    offset, length = position, len(blob)
+                    f.write(blob)
+                    position += length
+                    if found is not None:
+                        moved[found] = (offset, length)
+                    else:
+                        written[id(tile)] = (weakref.ref(tile), offset, length)
+                tiles.append([tx, ty, offset, length])
+                live += length
+            info["layers"].append({"name": layer.name, "opacity": layer.opacity, "visible": layer.visible,
+                                   "background": list(layer.surface.background), "tiles": tiles})
+        return info, live, moved, written
+
+    def write_index(self, f, info):
+        index = json.dumps(info, separators=(",", ":")).encode("utf-8")
+        offset = f.tell()
+        f.write(index)
+        f.flush()
+        os.fsync(f.fileno())
+        return offset, len(index)
@@ -0,0 +1,81 @@
+# Saves images on a worker thread. The caller hands over a snapshot, so
+# drawing can continue while it is encoded; each file is written under a
+# temporary name and renamed into place, so a crash or full disk never
+# leaves a half-written image behind. Projects look after that themselves
+# (see project.py).
+import os
+import queue
+import threading
+import time
+
+
+class Saver:
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = None
+        self.pending = 0
+
+    def save(self, snapshot, path, compress_level=6, project=None):
+        # With a project, the snapshot is saved into it instead of as a PNG
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.pending += 1
+        self.jobs.put((snapshot, path, compress_level, project))
+
+    def busy(self):
+        return self.pending > 0
+
+    def poll(self):
+        # Returns (path, error, seconds) for each save finished since the
+        # last poll; error is None on success and seconds is how long the
+        # worker spent on it. Call from the thread that calls save().
+        done = []
+        while True:
+            try:
+                done.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        self.pending -= len(done)
+        return done
+
+    def wait(self):
+        self.jobs.join()
+        return self.poll()
+
+    def close(self):
+        done = self.wait()
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+        return done
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            snapshot, path, compress_level, project = job
+            tmp = path + ".tmp"
+            start = time.perf_counter()
+            try:
+                if project is not None:
+                    project.save(snapshot)
+                    self.results.put((path, None, time.perf_counter() - start))
+                    continue
+                # Tiled snapshots are flattened here, off the UI thread
+                image = snapshot.to_image() if hasattr(snapshot, "to_image") else snapshot
+                image.save(tmp, "PNG", compress_level=compress_level)
+                os.replace(tmp, path)
+                self.results.put((path, None, time.perf_counter() - start))
+            except Exception as e:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                self.results.put((path, e, time.perf_counter() - start))
+            finally:
+                self.jobs.task_done()
@@ -0,0 +1,138 @@
+# Stamp images, decoded on demand and kept ready to paste. Thumbnails for
+# the stamp panel live in an index in cache/ keyed by path and mtime, so
+# the panel never has to decode a full stamp that has not changed. Decoded
+# stamps sit in a small LRU; each one carries pre-scaled variants, and each
+# variant an alpha mask made once, so pasting it is a single blit.
+from PIL import Image
+from collections import OrderedDict
+import base64
+import io
+import json
+import os
+
+
+class StampCache:
+    def __init__(self, directory="cache", capacity=32, sizes=(32, 64, 128), thumb_size=(32, 32)):
+        self.index_path = os.path.join(directory, "stamp_index.json")
+        self.capacity = capacity
+        self.sizes = sizes
+        self.thumb_size = thumb_size
+        self.stamps = OrderedDict()
+        self.thumbs = {}
+        self.index = {"thumbs": {}, "imports": {}}
+        self.dirty = False
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            if isinstance(index.get("thumbs"), dict) and isinstance(index.get("imports"), dict):
+                self.index = index
+        except (OSError, ValueError):
+            pass
+
+    def mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self, path, size=None):
+        # Returns (image, mask) for the stamp scaled so its longest side is
+        # size (None for its own size), or None if it cannot be read
+        mtime = self.mtime(path)
+        variants = self.stamps.get(path)
+        if variants is not None and variants["mtime"] == mtime:
+            self.stamps.move_to_end(path)
+        else:
+            variants = self.decode(path, mtime)
+            if variants is None:
+                return None
+            self.stamps[path] = variants
+            while len(self.stamps) > self.capacity:
+                self.stamps.popitem(last=False)
+        return variants.get(size, variants[None])
+
+    def decode(self, path, mtime):
+        try:
+            image = Image.open(path).convert("RGBA")
+        except Exception:
+            return None
+        variants = {"mtime": mtime, None: self.variant(image)}
+        for size in self.sizes:
+            scale = size / max(image.size)
+            scaled = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                                  Image.LANCZOS)
+            variants[size] = self.variant(scaled)
+        self.remember_thumb(path, mtime, image)
+        return variants
+
+    def variant(self, image):
+        # The mask carries the stamp's alpha and the image is made opaque, so
+        # paste(image, pos, mask) blends colour and alpha correctly even on
+        # a transparent layer
+        mask = image.getchannel("A")
+        solid = image.copy()
+        solid.putalpha(255)
+        return solid, mask
+
+    def thumbnail(self, path):
+        mtime = self.mtime(path)
+        thumb = self.thumbs.get(path)
+        if thumb is not None and thumb[0] == mtime:
+            return thumb[1]
+        entry = self.index["thumbs"].get(path)
+        if entry is not None and entry["mtime"] == mtime:
+            try:
+                image = Image.open(io.BytesIO(base64.b64decode(entry["png"])))
+                image.load()
+                self.thumbs[path] = (mtime, image)
+                return image
+            except Exception:
+                pass
+        try:
+            image = Image.open(path).convert("RGBA")
+        except Exception:
+            return None
+        return self.remember_thumb(path, mtime, image)
+
+    def remember_thumb(self, path, mtime, image):
+        thumb = image.resize(self.thumb_size)
+        self.thumbs[path] = (mtime, thumb)
+        data = io.BytesIO()
+        thumb.save(data, "PNG")
+        self.index["thumbs"][path] = {"mtime": mtime, "png": base64.b64encode(data.getvalue()).decode("ascii")}
+        self.dirty = True
+        return thumb
+
+    def import_stamp(self, source, directory, name, max_size=(64, 64)):
+        # Copies an image into directory as a stamp no bigger than max_size.
+        # Importing the same unchanged file again reuses the earlier copy.
+        mtime = self.mtime(source)
+        entry = self.index["imports"].get(source)
+        # Only a copy in directory counts: another window's copies go when it exits
+        if (entry is not None and entry["mtime"] == mtime and os.path.dirname(entry["file"]) == directory
+                and os.path.exists(entry["file"])):
+            return entry["file"]
+        image = Image.open(source).convert("RGBA")
+        image.thumbnail(max_size, Image.LANCZOS)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        image.save(path, "PNG")
+        self.index["imports"][source] = {"mtime": mtime, "file": path}
+        self.dirty = True
+        return path
+
+    def save_index(self):
+        if not self.dirty:
+            return
+        # Forget files that are gone
+        for table in (self.index["thumbs"], self.index["imports"]):
+            for key in [key for key in table if not os.path.exists(key)]:
+                del table[key]
+        tmp = self.index_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.index, f)
+            os.replace(tmp, self.index_path)
+            self.dirty = False
+        except OSError:
+            pass
@@ -0,0 +1,114 @@
+# Optional timing of the app's hot paths. Nothing is measured until
+# enable() is called: it shadows the chosen methods on one object with
+# timing wrappers, and disable() removes them again, so a disabled Stats
+# costs nothing and can stay in production builds.
+from collections import deque
+import bisect
+import csv
+import json
+import time
+
+# Histogram bucket upper bounds in milliseconds; the last bucket is open
+BOUNDS_MS = (0.25, 0.5, 1, 2, 4, 8, 16, 33, 66, 133, 266, 533, 1066)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th sample
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= p * self.count:
+                return BOUNDS_MS[i] if i < len(BOUNDS_MS) else self.max
+        return self.max
+
+    def row(self, name):
+        return {"name": name, "count": self.count, "total_ms": round(self.total, 3),
+                "mean_ms": round(self.total / self.count, 3) if self.count else 0,
+                "p50_ms": self.percentile(0.5), "p95_ms": self.percentile(0.95),
+                "p99_ms": self.percentile(0.99), "max_ms": round(self.max, 3),
+                "buckets": dict(zip([str(b) for b in BOUNDS_MS] + ["inf"], self.counts))}
+
+
+class Stats:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.enabled = False
+        self.histograms = {}
+        self.frames = deque(maxlen=600)
+        self.wrapped = []
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds * 1000)
+
+    def frame(self):
+        self.frames.append(self.clock())
+
+    def fps(self):
+        now = self.clock()
+        return sum(1 for t in self.frames if now - t <= 1.0)
+
+    def timed(self, name, func, label=None, frame=False):
+        def wrapper(*args, **kwargs):
+            start = self.clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(f"{name}[{label()}]" if label else name, self.clock() - start)
+                if frame:
+                    self.frame()
+        return wrapper
+
+    def enable(self, obj, names, label=None, frames=()):
+        # label() names the current mode (e.g. the tool) so each gets its own
+        # histogram; calls to methods in frames also count as a frame
+        if self.enabled:
+            return
+        for name in names:
+            setattr(obj, name, self.timed(name, getattr(obj, name), label, name in frames))
+            self.wrapped.append((obj, name))
+        self.enabled = True
+
+    def disable(self):
+        for obj, name in self.wrapped:
+            obj.__dict__.pop(name, None)
+        self.wrapped = []
+        self.enabled = False
+
+    def reset(self):
+        self.histograms.clear()
+        self.frames.clear()
+
+    def rows(self):
+        return sorted((h.row(name) for name, h in self.histograms.items()),
+                      key=lambda row: row["total_ms"], reverse=True)
+
+    def export(self, path, extra=None):
+        # JSON keeps everything; CSV has one row per histogram
+        rows = self.rows()
+        if path.lower().endswith(".csv"):
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                fields = ["name", "count", "total_ms", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+                buckets = [str(b) for b in BOUNDS_MS] + ["inf"]
+                writer = csv.writer(f)
+                writer.writerow(fields + [f"le_{b}" for b in buckets])
+                for row in rows:
+                    writer.writerow([row[k] for k in fields] + [row["buckets"][b] for b in buckets])
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"fps": self.fps(), **(extra or {}), "histograms": rows}, f, indent=2)
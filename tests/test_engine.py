@@ -0,0 +1,120 @@
+# Headless checks of the drawing engine: flood fill, history and layers
+from collections import deque
+import random
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from engine import Brush, Document, flood_fill_mask
+
+
+def naive_fill(arr, x, y, tolerance, connectivity):
+    # Plain pixel-by-pixel BFS to check the scanline fill against
+    height, width = arr.shape[:2]
+    target = arr[y, x].astype(int)
+    steps = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+    if connectivity == 8:
+        steps += [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+    filled = np.zeros((height, width), dtype=bool)
+    filled[y, x] = True
+    queue = deque([(x, y)])
+    while queue:
+        px, py = queue.popleft()
+        for dx, dy in steps:
+            nx, ny = px + dx, py + dy
+            if (0 <= nx < width and 0 <= ny < height and not filled[ny, nx]
+                    and np.all(np.abs(arr[ny, nx].astype(int) - target) <= tolerance)):
+                filled[ny, nx] = True
+                queue.append((nx, ny))
+    return filled
+
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+@pytest.mark.parametrize("tolerance", [0, 40])
+def test_flood_fill_matches_naive_bfs(connectivity, tolerance):
+    rng = np.random.default_rng(connectivity + tolerance)
+    for _ in range(40):
+        height, width = (int(v) for v in rng.integers(1, 40, 2))
+        # Few distinct values, alpha included, so regions are ragged
+        arr = (rng.integers(0, 3, (height, width, 4)) * 30).astype(np.uint8)
+        x, y = int(rng.integers(width)), int(rng.integers(height))
+        mask, bbox = flood_fill_mask(Image.fromarray(arr, "RGBA"), x, y, tolerance, connectivity)
+        expected = naive_fill(arr, x, y, tolerance, connectivity)
+        got = np.zeros((height, width), dtype=bool)
+        got[bbox[1]:bbox[3], bbox[0]:bbox[2]] = np.asarray(mask) > 0
+        assert np.array_equal(got, expected)
+
+
+def test_fill_respects_alpha_on_transparent_layer():
+    doc = Document(100, 100)
+    doc.add_layer()
+    region, bbox = doc.edit((0, 0, 100, 100))
+    ImageDraw.Draw(region).rectangle((20, 20, 80, 80), outline=(0, 0, 0, 255))
+    doc.apply(region, bbox)
+    assert doc.fill(5, 5, "#FF0000") is not None
+    assert doc.surface.crop((0, 0, 100, 100)).getpixel((50, 20)) == (0, 0, 0, 255)
+    # Black on transparent is a different colour from opaque black
+    assert doc.fill(50, 50, "#000000") is not None
+
+
+def test_undo_redo_round_trip():
+    doc = Document(300, 200)
+    before = np.asarray(doc.to_image()).copy()
+    doc.paint(Brush(12, "#3366FF"), [(10, 10), (290, 190)])
+    doc.commit()
+    after = np.asarray(doc.to_image()).copy()
+    assert not np.array_equal(before, after)
+    assert doc.undo() is not None
+    assert np.array_equal(np.asarray(doc.to_image()), before)
+    assert doc.redo() is not None
+    assert np.array_equal(np.asarray(doc.to_image()), after)
+
+
+def test_deleted_layer_leaves_no_undo_steps():
+    doc = Document(200, 100)
+    doc.paint(Brush(8, "#FF0000"), [(10, 10), (190, 10)])
+    doc.commit()
+    doc.add_layer()
+    doc.paint(Brush(8, "#0000FF"), [(10, 50), (190, 50)])
+    doc.commit()
+    doc.delete_layer(1)
+    before = np.asarray(doc.to_image()).copy()
+    # The next undo is the red stroke, not the deleted layer's blue one
+    assert doc.undo() is not None
+    assert not np.array_equal(np.asarray(doc.to_image()), before)
+    assert doc.undo() is None
+
+
+def test_layers_composite_like_pil():
+    rng = random.Random(3)
+    doc = Document(160, 120)
+    expected = Image.new("RGBA", (160, 120), "white")
+    for i, opacity in enumerate((1.0, 0.5)):
+        doc.add_layer()
+        doc.set_layer(doc.active, opacity=opacity)
+        layer = Image.new("RGBA", (160, 120), (0, 0, 0, 0))
+        color = "#%06X" % rng.randrange(1 << 24)
+        box = (10 + 30 * i, 10, 100 + 30 * i, 100)
+        region, bbox = doc.edit((0, 0, 160, 120))
+        ImageDraw.Draw(region).rectangle(box, fill=color)
+        doc.apply(region, bbox)
+        ImageDraw.Draw(layer).rectangle(box, fill=color)
+        alpha = layer.getchannel("A").point(lambda v: round(v * opacity))
+        layer.putalpha(alpha)
+        expected.alpha_composite(layer)
+    got = np.asarray(doc.to_image()).astype(int)
+    # Opacity may round differently by one
+    assert np.abs(got - np.asarray(expected).astype(int)).max() <= 1
+    # Regions come out the same as the whole image
+    assert np.array_equal(np.asarray(doc.crop((37, 21, 140, 97))), np.asarray(doc.to_image())[21:97, 37:140])
+
+
+def test_selection_clips_painting():
+    doc = Document(200, 200)
+    doc.select_rect((50, 50, 100, 100))
+    before = np.asarray(doc.to_image()).copy()
+    doc.paint(Brush(30, "#00FF00"), [(0, 75), (199, 75)])
+    changed = np.any(np.asarray(doc.to_image()) != before, axis=2)
+    ys, xs = np.nonzero(changed)
+    assert len(xs) and xs.min() >= 50 and xs.max() < 100 and ys.min() >= 50 and ys.max() < 100
@@ -0,0 +1,95 @@
+# Crash recovery: what the journal rebuilds must match the live document
+import numpy as np
+import pytest
+from PIL import ImageDraw
+
+from engine import Brush, Document
+from journal import Journal, replay
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return str(tmp_path / "cache")
+
+
+def recovered(cache):
+    journal = Journal(cache)
+    assert journal.has_recovery()
+    composite, records = journal.recover()
+    doc = Document(1, 1)
+    doc.restore(composite)
+    for record in records:
+        replay(doc, record, None)
+    journal.close()
+    return doc
+
+
+def paint(doc, journal, points, color, size=10):
+    doc.paint(Brush(size, color), points)
+    doc.commit()
+    journal.record("paint", segments=[[list(p) for p in points]], color=color, size=size, hardness=1.0,
+                   spacing=0.15)
+
+
+def test_recovery_matches_live_document(cache):
+    doc = Document(240, 160)
+    journal = Journal(cache)
+    journal.start(doc.snapshot())
+    paint(doc, journal, [(10, 10), (230, 150)], "#FF0000")
+    doc.add_layer("Ink")
+    journal.record("layer_add", name="Ink")
+    paint(doc, journal, [(10, 150), (230, 10)], "#0000FF")
+    doc.fill(120, 20, "#00FF00")
+    journal.record("fill", x=120, y=20, color="#00FF00", tolerance=0, connectivity=4)
+    doc.commit()
+    # Undo is journaled as a patch of what it restored
+    bbox = doc.undo()
+    journal.record("patch", x=bbox[0], y=bbox[1], layer=doc.active, image=doc.surface.crop(bbox))
+    doc.set_layer(1, opacity=0.5)
+    journal.record("layer_set", index=1, opacity=0.5)
+    journal.close(discard=False)
+    assert np.array_equal(np.asarray(recovered(cache).to_image()), np.asarray(doc.to_image()))
+
+
+@pytest.mark.parametrize("kind", ["rect", "wand"])
+def test_selection_survives_a_checkpoint(cache, kind):
+    doc = Document(200, 200)
+    region, bbox = doc.edit((0, 0, 200, 200))
+    ImageDraw.Draw(region).ellipse((20, 20, 120, 120), fill="blue")
+    doc.apply(region, bbox)
+    doc.commit()
+    journal = Journal(cache)
+    journal.start(doc.snapshot())
+    if kind == "rect":
+        doc.select_rect((0, 0, 50, 50))
+        journal.record("select", kind="rect", coords=[0, 0, 50, 50])
+    else:
+        doc.select_wand(70, 70)
+        journal.record("select", kind="wand", x=70, y=70, tolerance=0, connectivity=4, limit=None)
+        # The wand wouldn't pick the same pixels again after this
+        doc.fill(70, 70, "#00FF00")
+        journal.record("fill", x=70, y=70, color="#00FF00", tolerance=0, connectivity=4)
+    journal.start(doc.snapshot(), doc.selection)
+    paint(doc, journal, [(0, 30), (199, 30)], "#FF0000", size=20)
+    journal.close(discard=False)
+    assert np.array_equal(np.asarray(recovered(cache).to_image()), np.asarray(doc.to_image()))
+
+
+def test_live_sessions_are_not_offered(cache):
+    live = Journal(cache)
+    live.start(Document(50, 50).snapshot())
+    live.record("erase", points=[[5, 5]], radius=3)
+    other = Journal(cache)
+    assert not other.has_recovery()
+    other.close()
+    # Once the first window stops without cleaning up, as in a crash, its
+    # session is offered; declining deletes only that session
+    live.close(discard=False)
+    survivor = Journal(cache)
+    survivor.start(Document(50, 50).snapshot())
+    late = Journal(cache)
+    assert late.has_recovery()
+    late.discard_recovery()
+    late.close()
+    survivor.close(discard=False)
+    assert survivor.generations()
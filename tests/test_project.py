@@ -0,0 +1,92 @@
+# Round trips through .craft project files
+import os
+
+import numpy as np
+from PIL import Image
+
+import project
+from engine import Brush, Document
+from project import Project
+
+
+def noisy_doc(width=400, height=300):
+    doc = Document(1, 1)
+    doc.load(Image.effect_noise((width, height), 60).convert("RGBA"))
+    doc.add_layer("Top")
+    doc.paint(Brush(15, "#FF0000"), [(0, 0), (width - 1, height - 1)])
+    doc.commit()
+    doc.set_layer(1, opacity=0.6)
+    return doc
+
+
+def pixels(composite):
+    return np.asarray(composite.to_image())
+
+
+def reopen(path):
+    opened, composite = Project.open(path)
+    image = pixels(composite)
+    opened.close()
+    return composite, image
+
+
+def test_save_and_reopen(tmp_path):
+    path = str(tmp_path / "a.craft")
+    doc = noisy_doc()
+    Project(path).save(doc.snapshot())
+    composite, image = reopen(path)
+    assert np.array_equal(image, pixels(doc))
+    assert [(layer.name, layer.opacity) for layer in composite.layers] == [("Background", 1.0), ("Top", 0.6)]
+    assert composite.active == doc.active
+
+
+def test_incremental_save_after_undo(tmp_path):
+    path = str(tmp_path / "a.craft")
+    doc = noisy_doc()
+    saved = Project(path)
+    saved.save(doc.snapshot())
+    first = os.path.getsize(path)
+    doc.paint(Brush(9, "#0000FF"), [(20, 150), (60, 150)])
+    doc.commit()
+    saved.save(doc.snapshot())
+    doc.undo()
+    saved.save(doc.snapshot())
+    # Only the changed tiles and the indexes were appended
+    assert os.path.getsize(path) - first < first / 4
+    assert np.array_equal(reopen(path)[1], pixels(doc))
+
+
+def test_compaction_keeps_pixels_and_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(project, "COMPACT_MIN_BYTES", 0)
+    path = str(tmp_path / "a.craft")
+    Project(path).save(noisy_doc().snapshot())
+    first = os.path.getsize(path)
+    opened, composite = Project.open(path)
+    doc = Document(1, 1)
+    doc.restore(composite)
+    doc.select_layer(0)
+    start = pixels(doc).copy()
+    # Repaint most of the noise, so the old ones outweigh the live ones
+    for y in range(0, 300, 20):
+        doc.paint(Brush(22, "#00AA00"), [(0, y), (399, y)])
+        doc.commit()
+        opened.save(doc.snapshot())
+    # Without compaction every repainted tile would still be in the file
+    assert os.path.getsize(path) < 2 * first
+    assert np.array_equal(reopen(path)[1], pixels(doc))
+    # Undo reaches tiles that were still compressed in the file before it
+    # was rewritten
+    while doc.undo() is not None:
+        pass
+    assert np.array_equal(pixels(doc), start)
+    opened.close()
+
+
+def test_save_as_over_another_project_replaces_it(tmp_path):
+    path = str(tmp_path / "a.craft")
+    Project(path).save(noisy_doc(800, 600).snapshot())
+    big = os.path.getsize(path)
+    small = Document(64, 64)
+    Project(path).save(small.snapshot())
+    assert os.path.getsize(path) < big / 10
+    assert np.array_equal(reopen(path)[1], pixels(small))